@@ -21,9 +21,9 @@ from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from homeassistant.helpers.area_registry import AreaEntry, AreaRegistry
 import homeassistant.helpers.area_registry as area_registry
 
-from .const import DOMAIN, CONF_POLLING, CONF_SYNC_ROOMS
+from .const import DOMAIN, CONF_POLLING, CONF_KEEPALIVE_INTERVAL, CONF_SYNC_ROOMS
 from .light import KlyqaLight
-from .api import Klyqa
+from .api import KEEPALIVE_INTERVAL, Klyqa
 
 from homeassistant.const import (
     ATTR_ENTITY_ID,
@@ -54,34 +54,35 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     sync_rooms = (
         entry.data.get(CONF_SYNC_ROOMS) if entry.data.get(CONF_SYNC_ROOMS) else False
     )
-    klyqa_api: Klyqa
-    if DOMAIN in hass.data:
-        klyqa_api = hass.data[DOMAIN]
-        await hass.async_add_executor_job(klyqa_api.shutdown)
-
-        klyqa_api._username = username
-        klyqa_api._password = password
-        klyqa_api._host = host
+    keepalive_interval = entry.data.get(CONF_KEEPALIVE_INTERVAL) or KEEPALIVE_INTERVAL
+    klyqa_api: Klyqa = hass.data.get(DOMAIN)
+    if klyqa_api:
+        await klyqa_api.async_shutdown()
+
+    # keep the loaded devices only for the same account
+    if klyqa_api and klyqa_api.cloud.username == username:
+        klyqa_api.cloud.password = password
+        klyqa_api.cloud.host = host
         klyqa_api.sync_rooms = sync_rooms
+        klyqa_api.keepalive_interval = keepalive_interval
     else:
-        klyqa_api: Klyqa = await hass.async_add_executor_job(
-            Klyqa,
+        klyqa_api: Klyqa = Klyqa(
             username,
             password,
             host,
             hass,
             False,
             sync_rooms,
+            keepalive_interval,
         )
         hass.data[DOMAIN] = klyqa_api
 
-    if not await hass.async_add_executor_job(
-        klyqa_api.login,
-    ):
+    await klyqa_api.async_load_store()
+    # with stored devices the lights start right away and login in the background
+    if not klyqa_api.devices and not await klyqa_api.cloud.login():
         return False
 
-    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa_api.shutdown)
-    await hass.async_add_executor_job(klyqa_api.load_settings)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa_api.async_shutdown)
     # await hass.async_add_executor_job(klyqa.search_lights)
 
     # hass.data.setdefault(DOMAIN, {})[entry.entry_id] = co
@@ -103,7 +104,7 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
 
-    await hass.async_add_executor_job(hass.data[DOMAIN].shutdown)
+    await hass.data[DOMAIN].async_shutdown(logout=True)
 
     hass.data.pop(DOMAIN)
 
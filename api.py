@@ -1,23 +1,25 @@
+from __future__ import annotations
+
 import argparse
 import asyncio
-import datetime
+import base64
+import collections
 import json
-import pickle
-import select
+import logging
 import socket
-import sys
-import time
 import traceback
-import os
-import errno
-import threading
+import random
+import time
 
 import uuid
-import requests
+import aiohttp
 
-from typing import Any, cast
+from dataclasses import dataclass, field
+from typing import Any, Callable, ClassVar, cast
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers import area_registry as ar
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.storage import Store
 
 # pycryptodome
 try:
@@ -27,11 +29,52 @@ except:
     from Crypto.Cipher import AES
     from Crypto.Random import get_random_bytes
 
-from .const import CONF_POLLING, DEFAULT_CACHEDB, DOMAIN, LOGGER
+from .const import CONF_POLLING, DOMAIN, LOGGER, STORAGE_KEY, STORAGE_VERSION
 
 STATE_CONNECTED = "CONNECTED"
 STATE_WAIT_IV = "WAIT_IV"
 
+HANDSHAKE_TIMEOUT = 5
+# bulbs handshaked in parallel by the discovery listener
+HANDSHAKE_WORKERS = 16
+# seconds between probes of an unreachable light, doubled per probe up to the max
+REDISCOVERY_BACKOFF_MIN = 2
+REDISCOVERY_BACKOFF_MAX = 300
+REDISCOVERY_JITTER = 0.2
+REDISCOVERY_IDLE_INTERVAL = 5
+# unicast probes to the last address before a light is also searched by broadcast
+REDISCOVERY_UNICAST_PROBES = 3
+# seconds a connection may be idle before the supervisor pings it
+KEEPALIVE_INTERVAL = 30
+
+# seconds to connect and read for a cloud request
+HTTP_TIMEOUT = 10
+HTTP_RETRIES = 3
+# seconds before the first retry of a failed cloud request, doubled per retry
+HTTP_BACKOFF = 0.3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+# seconds before the access token expires it is refreshed in the background
+TOKEN_REFRESH_MARGIN = 60
+TOKEN_REFRESH_RETRY = 15
+# seconds the loaded account settings are used before asking the cloud again
+SETTINGS_TTL = 60
+# seconds a product config is used before it is refreshed in the background
+PRODUCT_CONFIG_TTL = 24 * 60 * 60
+# seconds changes are collected before the stored state is written
+STORAGE_SAVE_DELAY = 10
+RESPONSE_TIMEOUT = 1
+# seconds the event loop may be blocked before the loop monitor reports it
+LOOP_BLOCK_THRESHOLD = 0.1
+LOOP_MONITOR_INTERVAL = 1
+
+# answer types the bulb sends back per request message type
+REPLY_TYPES = {
+    "request": ("status",),
+    "ping": ("pong",),
+    "routine": ("routine",),
+}
+KNOWN_REPLY_TYPES = {"status", "pong", "routine"}
+
 SCENES = [
     {
         "id": 100,
@@ -214,109 +257,661 @@ class Connection:
     sending_aes = None
     receiving_aes = None
     state = ""
-    socket: socket.SocketType
+    reader: asyncio.StreamReader = None
+    writer: asyncio.StreamWriter = None
     address = ""
     local_iv = ""
     remote_iv = ""
+    aes_key = b""
     u_id = ""
+    reader_task: asyncio.Task = None
+    # loop time of the last data received from the bulb
+    last_activity = 0.0
+    # seconds of the last request answer round trip
+    rtt: float = None
+    # rest of a command sequence waiting for the transitions of the bulb
+    tail: asyncio.Task = None
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.connected = asyncio.Event()
+        self.in_flight: collections.deque = collections.deque()
+        """In-flight requests in send order: (reply types, future, send time)."""
+
+    def expect(self, message_type) -> asyncio.Future:
+        """Register a request in the in-flight table and return its answer future."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight.append((REPLY_TYPES.get(message_type), future, loop.time()))
+        return future
+
+    def forget(self, future: asyncio.Future):
+        """Remove a request from the in-flight table, e.g. after a timeout."""
+        for entry in self.in_flight:
+            if entry[1] is future:
+                self.in_flight.remove(entry)
+                break
+        future.cancel()
 
+    def resolve(self, response: dict) -> bool:
+        """
+        Match an answer to the oldest in-flight request expecting its type.
+        Answers of unknown types go to the oldest request. Abandoned requests
+        absorb their answers for the response timeout, older ones are dropped
+        so a lost answer does not shift all following answers.
 
-def send_msg(socket, message, sending_aes) -> bool:
-    LOGGER.debug("Sending: " + message)
-    message_encoded = message.encode("utf-8")
-    while len(message_encoded) % 16:
-        message_encoded = message_encoded + bytes([0x20])
-
-    message_encrypted = sending_aes.encrypt(message_encoded)
-    retry_counter = 0
+        Returns:
+            bool: True if the answer belonged to a request.
+        """
+        now = asyncio.get_running_loop().time()
+        if any(
+            future.done() and now - sent > RESPONSE_TIMEOUT
+            for _, future, sent in self.in_flight
+        ):
+            self.in_flight = collections.deque(
+                entry
+                for entry in self.in_flight
+                if not entry[1].done() or now - entry[2] <= RESPONSE_TIMEOUT
+            )
 
-    while retry_counter < 10:
-        try:
-            socket.send(
-                bytes(
-                    [len(message_encrypted) // 256, len(message_encrypted) % 256, 0, 2]
-                )
-                + message_encrypted
+        reply_type = response.get("type")
+        for entry in self.in_flight:
+            reply_types, future, sent = entry
+            if (
+                reply_types is None
+                or reply_type in reply_types
+                or reply_type not in KNOWN_REPLY_TYPES
+            ):
+                self.in_flight.remove(entry)
+                if not future.done():
+                    self.rtt = now - sent
+                    future.set_result(response)
+                return True
+        return False
+
+    def fail_in_flight(self):
+        """Wake up all requests waiting for an answer on a lost connection."""
+        while self.in_flight:
+            _, future, _ = self.in_flight.popleft()
+            if not future.done():
+                future.set_result(None)
+
+    @property
+    def closed(self) -> bool:
+        """Return True if the tcp stream to the bulb is gone or closing."""
+        return self.writer is None or self.writer.is_closing()
+
+    def cancel_tail(self):
+        """Drop the pending rest of the last command sequence."""
+        if self.tail is not None and not self.tail.done():
+            self.tail.cancel()
+        self.tail = None
+
+    def close(self):
+        """Close the tcp stream to the bulb."""
+        self.cancel_tail()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def set_socket_options(sock: socket.socket, keepalive_interval=KEEPALIVE_INTERVAL):
+    """Disable Nagle and enable tcp keepalive on a bulb connection."""
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(keepalive_interval)
             )
-            return True
-        except socket.timeout:
-            LOGGER.debug("Send timed out, retrying...")
-        except Exception as excp:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except OSError:
+        LOGGER.debug(traceback.format_exc())
+
+
+def frame_msg(message: dict, sending_aes) -> bytes:
+    """
+    Encode, pad and encrypt a message into one tcp frame
+    [len_hi, len_lo, 0, 2] + ciphertext. The message is padded with spaces
+    to the AES block size in one step and the header is joined once. For
+    bulb sized messages this is faster than encrypting in place into a
+    preallocated frame, see benchmark.py.
+    """
+    message_encoded = json.dumps(message).encode("utf-8")
+    message_encoded += b" " * (-len(message_encoded) % 16)
+    cipher = sending_aes.encrypt(message_encoded)
+    return bytes((len(cipher) // 256, len(cipher) % 256, 0, 2)) + cipher
+
+
+async def send_msg(writer: asyncio.StreamWriter, message: dict, sending_aes) -> bool:
+    """
+    Write the framed message in one write call. If the transport could not
+    hand everything to the socket, the backpressure is reported and drained
+    within the response timeout instead of sleeping and resending.
+    """
+    LOGGER.debug("Sending: %s", message)
+    try:
+        writer.write(frame_msg(message, sending_aes))
+    except (ConnectionError, OSError, RuntimeError):
+        LOGGER.error("Could not send message on tcp connection...")
+        LOGGER.debug(traceback.format_exc())
+        return False
+
+    pending = writer.transport.get_write_buffer_size()
+    if pending:
+        LOGGER.debug("Backpressure, %d bytes not written to the bulb yet", pending)
+        try:
+            await asyncio.wait_for(writer.drain(), RESPONSE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
             LOGGER.error("Could not send message on tcp connection...")
-            LOGGER.error(traceback.format_exc())
-        time.sleep(0.3)
-        retry_counter += 1
-
-    return False
-
-
-def color_message(red, green, blue, transition, skip_wait=False):
-    wait_time = transition if not skip_wait else 0
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "color": {
-                    "red": red,
-                    "green": green,
-                    "blue": blue,
-                },
-                "transitionTime": transition,
-            }
-        ),
-        wait_time,
-    )
+            return False
 
+    return True
 
-def temperature_message(temperature, transition, skip_wait=False):
-    wait_time = transition if not skip_wait else 0
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "temperature": temperature,
-                "transitionTime": transition,
-            }
-        ),
-        wait_time,
-    )
 
+@dataclass
+class Command:
+    """Typed bulb command that encodes straight to the wire message."""
+
+    type: ClassVar[str] = "request"
+    # light state commands can be merged into one request frame
+    combinable: ClassVar[bool] = False
+    # read-only commands leave a running command sequence untouched
+    changes_state: ClassVar[bool] = True
+
+    def msg(self) -> dict:
+        """Return the json message for the bulb."""
+        return {"type": self.type}
+
+    def wait_time(self) -> int:
+        """Return the milliseconds the bulb is busy before the next command of a sequence."""
+        return 0
+
+
+@dataclass
+class RequestCmd(Command):
+    """Request the bulb status."""
+
+    changes_state: ClassVar[bool] = False
+
+
+@dataclass
+class PingCmd(Command):
+    type: ClassVar[str] = "ping"
+    changes_state: ClassVar[bool] = False
+
+
+@dataclass
+class PowerCmd(Command):
+    status: str
+    combinable: ClassVar[bool] = True
+
+    def msg(self) -> dict:
+        return {"type": self.type, "status": self.status}
+
+
+@dataclass
+class TransitionCmd(Command):
+    """Command fading the bulb over transition milliseconds."""
+
+    combinable: ClassVar[bool] = True
+
+    def __post_init__(self):
+        self.transition = int(self.transition)
+
+    def msg(self) -> dict:
+        return {"type": self.type, "transitionTime": self.transition}
+
+    def wait_time(self) -> int:
+        return 0 if self.skip_wait else self.transition
+
+
+@dataclass
+class ColorCmd(TransitionCmd):
+    red: int
+    green: int
+    blue: int
+    transition: int = 0
+    skip_wait: bool = False
+
+    def msg(self) -> dict:
+        return {
+            **super().msg(),
+            "color": {
+                "red": self.red,
+                "green": self.green,
+                "blue": self.blue,
+            },
+        }
+
+
+@dataclass
+class TemperatureCmd(TransitionCmd):
+    temperature: int
+    transition: int = 0
+    skip_wait: bool = False
+
+    def msg(self) -> dict:
+        return {**super().msg(), "temperature": self.temperature}
+
+
+@dataclass
+class PercentColorCmd(TransitionCmd):
+    red: int
+    green: int
+    blue: int
+    warm: int
+    cold: int
+    transition: int = 0
+    skip_wait: bool = False
+
+    def msg(self) -> dict:
+        return {
+            **super().msg(),
+            "p_color": {
+                "red": self.red,
+                "green": self.green,
+                "blue": self.blue,
+                "warm": self.warm,
+                "cold": self.cold,
+                # "brightness" : brightness
+            },
+        }
+
+
+@dataclass
+class BrightnessCmd(TransitionCmd):
+    percentage: int
+    transition: int = 0
+    skip_wait: bool = False
+
+    def msg(self) -> dict:
+        return {**super().msg(), "brightness": {"percentage": self.percentage}}
+
+
+# only one of them can be set per request, they select the light mode
+MODE_FIELDS = {"color", "temperature", "p_color"}
+
+
+@dataclass
+class LightStateCmd(Command):
+    """Power, color or temperature and brightness of the bulb in one request frame."""
+
+    parts: list[Command] = field(default_factory=list)
 
-def percent_color_message(red, green, blue, warm, cold, transition, skip_wait):
-    wait_time = transition if not skip_wait else 0
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "p_color": {
-                    "red": red,
-                    "green": green,
-                    "blue": blue,
-                    "warm": warm,
-                    "cold": cold,
-                    # "brightness" : brightness
-                },
-                "transitionTime": transition,
-            }
-        ),
-        wait_time,
+    def accepts(self, command: Command) -> bool:
+        """Return True if the command can be merged without conflicts."""
+        merged = self.msg()
+        message = command.msg()
+        fields = message.keys() - {"type", "transitionTime"}
+        if fields & merged.keys():
+            return False
+        if len((fields | merged.keys()) & MODE_FIELDS) > 1:
+            return False
+        return (
+            "transitionTime" not in merged
+            or "transitionTime" not in message
+            or merged["transitionTime"] == message["transitionTime"]
+        )
+
+    def msg(self) -> dict:
+        merged = {"type": self.type}
+        for part in self.parts:
+            merged.update(part.msg())
+        return merged
+
+    def wait_time(self) -> int:
+        return max((part.wait_time() for part in self.parts), default=0)
+
+
+def combine_commands(commands) -> list[Command]:
+    """Merge runs of light state commands into single request frames."""
+    combined: list[Command] = []
+    for command in commands:
+        last = combined[-1] if combined else None
+        if not command.combinable:
+            combined.append(command)
+        elif isinstance(last, LightStateCmd) and last.accepts(command):
+            last.parts.append(command)
+        else:
+            combined.append(LightStateCmd([command]))
+    return [
+        command.parts[0]
+        if isinstance(command, LightStateCmd) and len(command.parts) == 1
+        else command
+        for command in combined
+    ]
+
+
+@dataclass
+class FwUpdateCmd(Command):
+    url: str
+    type: ClassVar[str] = "fw_update"
+
+    def msg(self) -> dict:
+        return {"type": self.type, "url": self.url}
+
+
+@dataclass
+class BackendCmd(Command):
+    link_enabled: str
+    type: ClassVar[str] = "backend"
+
+    def msg(self) -> dict:
+        return {"type": self.type, "link_enabled": self.link_enabled}
+
+
+@dataclass
+class FactoryResetCmd(Command):
+    type: ClassVar[str] = "factory_reset"
+
+
+@dataclass
+class RebootCmd(Command):
+    type: ClassVar[str] = "reboot"
+
+
+@dataclass
+class RoutineListCmd(Command):
+    type: ClassVar[str] = "routine"
+    changes_state: ClassVar[bool] = False
+
+    def msg(self) -> dict:
+        return {"type": self.type, "action": "list"}
+
+
+@dataclass
+class RoutinePut(Command):
+    id: str
+    scene: str
+    commands: str
+    type: ClassVar[str] = "routine"
+
+    def msg(self) -> dict:
+        return {
+            "type": self.type,
+            "action": "put",
+            "id": self.id,
+            "scene": self.scene,
+            "commands": self.commands,
+        }
+
+
+@dataclass
+class RoutineDelete(Command):
+    id: str
+    type: ClassVar[str] = "routine"
+
+    def msg(self) -> dict:
+        return {"type": self.type, "action": "delete", "id": self.id}
+
+
+@dataclass
+class RoutineStart(Command):
+    id: str
+    type: ClassVar[str] = "routine"
+
+    def msg(self) -> dict:
+        return {"type": self.type, "action": "start", "id": self.id}
+
+
+@dataclass
+class PartyCmd(Command):
+    """Blink fast and furious with random colors until the next command."""
+
+    transition: int = 300
+
+    def next_color(self) -> ColorCmd:
+        r, g, b = get_random_bytes(3)
+        return ColorCmd(r, g, b, self.transition)
+
+
+def _argv_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="virtual App interface")
+
+    parser.add_argument("--color", nargs=3, type=int, help="set color command (r,g,b) 0-255")
+    parser.add_argument(
+        "--temperature",
+        nargs=1,
+        type=int,
+        help="set temperature command (kelvin 1000-12000) (1000:warm, 12000:cold)",
+    )
+    parser.add_argument(
+        "--brightness", nargs=1, type=int, help="set brightness in percent 0-100"
+    )
+    parser.add_argument(
+        "--percent_color",
+        nargs=5,
+        type=int,
+        metavar=("RED", "GREEN", "BLUE", "WARM", "COLD"),
+        help="set colors and white tones in percent 0 - 100",
+    )
+    parser.add_argument(
+        "--transitionTime",
+        nargs=1,
+        type=int,
+        help="transition time in milliseconds",
+        default=[0],
+    )
+    parser.add_argument(
+        "--power", nargs=1, metavar='"on"/"off"', help="turns the bulb on/off"
+    )
+    parser.add_argument(
+        "--party",
+        help="blink fast and furious",
+        action="store_const",
+        const=True,
+        default=False,
     )
 
+    parser.add_argument(
+        "--myip", nargs=1, help="specify own IP for broadcast sender"
+    )
+    parser.add_argument("--ota", nargs=1, help="specify http URL for ota")
+    parser.add_argument(
+        "--ping", help="send ping", action="store_const", const=True, default=False
+    )
+    parser.add_argument(
+        "--request",
+        help="send status request",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--factory_reset",
+        help="trigger a factory reset on the device (Warning: device has to be onboarded again afterwards)",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_list",
+        help="lists stored routines",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_put",
+        help="store new routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_delete",
+        help="delete routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_start",
+        help="start routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_id", help="specify routine id to act on (for put, start, delete)"
+    )
+    parser.add_argument(
+        "--routine_scene", help="specify routine scene label (for put)"
+    )
+    parser.add_argument(
+        "--routine_commands", help="specify routine program (for put)"
+    )
+    parser.add_argument(
+        "--reboot",
+        help="trigger a reboot",
+        action="store_const",
+        const=True,
+        default=False,
+    )
 
-def brightness_message(brightness, transition):
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "brightness": {
-                    "percentage": brightness,
-                },
-                "transitionTime": transition,
-            }
-        ),
-        transition,
+    parser.add_argument(
+        "--passive",
+        help="vApp will passively listen vor UDP SYN from devices",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--enable_tb", nargs=1, help="enable thingsboard connection (yes/no)"
     )
 
+    return parser
+
+
+ARGV_PARSER = _argv_parser()
+
+
+def commands_from_argv(*argv) -> list[Command]:
+    """
+    Command line adapter: translate the argv form into typed commands.
+    The commands are ordered like the bulb messages were sent before.
+
+    Returns:
+        list: The typed commands.
+        None: On invalid arguments.
+    """
+    if len(argv) < 1:
+        ARGV_PARSER.print_help()
+        return None
+
+    args = ARGV_PARSER.parse_args(argv)
+
+    commands: list[Command] = []
+    transition = args.transitionTime[0]
+    skip_wait = args.brightness is not None
+
+    if args.ota is not None:
+        commands.append(FwUpdateCmd(args.ota[0]))
+
+    if args.ping:
+        commands.append(PingCmd())
+
+    if args.request:
+        commands.append(RequestCmd())
+
+    if args.enable_tb is not None:
+        answer = args.enable_tb[0]
+        if answer != "yes" and answer != "no":
+            LOGGER.error("ERROR --enable_tb needs to be yes or no")
+            return None
+
+        commands.append(BackendCmd(answer))
+
+    if args.color is not None:
+        commands.append(ColorCmd(*args.color, transition, skip_wait=skip_wait))
+
+    if args.temperature is not None:
+        commands.append(
+            TemperatureCmd(args.temperature[0], transition, skip_wait=skip_wait)
+        )
+
+    if args.brightness is not None:
+        commands.append(BrightnessCmd(args.brightness[0], transition))
+
+    if args.percent_color is not None:
+        commands.append(
+            PercentColorCmd(*args.percent_color, transition, skip_wait=skip_wait)
+        )
+
+    if args.factory_reset:
+        commands.append(FactoryResetCmd())
+
+    if args.routine_list:
+        commands.append(RoutineListCmd())
+
+    if args.routine_put:
+        commands.append(
+            RoutinePut(args.routine_id, args.routine_scene, args.routine_commands)
+        )
+
+    if args.routine_delete:
+        commands.append(RoutineDelete(args.routine_id))
+
+    if args.routine_start:
+        commands.append(RoutineStart(args.routine_id))
+
+    if args.power:
+        commands.append(PowerCmd(args.power[0]))
+
+    if args.reboot:
+        commands.append(RebootCmd())
+
+    if args.party:
+        commands.append(PartyCmd(transition or 300))
+
+    return commands
+
+
+@dataclass
+class DeviceRecord:
+    """Account settings of a device indexed by its local device id."""
+
+    u_id: str
+    aes_key: bytes
+    product_id: str
+    settings: dict
+    rooms: list[dict] = field(default_factory=list)
+    """Rooms of the account containing the device."""
+    routines: list[dict] = field(default_factory=list)
+    """Routines with a task for the device."""
+    timers: list[dict] = field(default_factory=list)
+    """Timers with a task for the device."""
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> DeviceRecord:
+        return cls(
+            settings["localDeviceId"],
+            bytes.fromhex(settings["aesKey"]),
+            settings["productId"],
+            settings,
+        )
+
+
+@dataclass
+class Backoff:
+    """Exponential backoff with jitter for probing an unreachable light."""
+
+    delay: float = REDISCOVERY_BACKOFF_MIN
+    next_probe: float = 0
+    probes: int = 0
+    """Probes sent since the light went missing."""
+
+    def probed(self, now: float):
+        """Schedule the next probe after a probe was sent."""
+        self.probes += 1
+        self.next_probe = now + self.delay * random.uniform(
+            1 - REDISCOVERY_JITTER, 1 + REDISCOVERY_JITTER
+        )
+        self.delay = min(self.delay * 2, REDISCOVERY_BACKOFF_MAX)
+
 
 class KlyqaLightDevice:
     state = {}
@@ -327,13 +922,210 @@ class KlyqaLightDevice:
         self.connection = connection
 
 
+@dataclass
+class CloudResponse:
+    """Status, headers and body of a finished klyqa cloud request."""
+
+    status_code: int
+    text: str
+    headers: Any = field(default_factory=dict)
+
+
+def token_expiry(token: str) -> float:
+    """Expiry of a jwt as unix time, None if the token does not tell."""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class KlyqaCloud:
+    """Async klyqa cloud client on the shared Home Assistant http session."""
+
+    access_token = ""
+    account_token = ""
+    token_expires_at: float = None
+    """Unix time the access token expires, None if unknown."""
+    _login_task: asyncio.Task = None
+    _refresh_task: asyncio.Task = None
+    on_token_change: Callable[[], None] = None
+    """Called after the tokens changed, e.g. to store them."""
+
+    def __init__(self, username, password, host, hass: HomeAssistant = None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.hass = hass
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return async_get_clientsession(self.hass)
+
+    def bearer(self) -> dict:
+        """Authorization headers with a new request id for each request."""
+        return {
+            "Authorization": "Bearer " + self.access_token,
+            "X-Request-Id": str(uuid.uuid4()),
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "accept-encoding": "gzip, deflate, utf-8",
+        }
+
+    async def _request(self, method, url, **kwargs) -> CloudResponse:
+        """Send a request, retry get requests on connection and server errors."""
+        retries = HTTP_RETRIES if method == "GET" else 0
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        for attempt in range(retries + 1):
+            try:
+                async with self.session.request(
+                    method, self.host + url, timeout=timeout, **kwargs
+                ) as response:
+                    if (
+                        response.status not in HTTP_RETRY_STATUSES
+                        or attempt == retries
+                    ):
+                        return CloudResponse(
+                            response.status,
+                            await response.text(),
+                            response.headers.copy(),
+                        )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(HTTP_BACKOFF * 2**attempt)
+
+    async def login(self) -> bool:
+        """
+        Login to klyqa account. Parallel callers share one login, so requests
+        finding an expired token do not all login again on their own.
+        """
+        if self._login_task is None or self._login_task.done():
+            self._login_task = asyncio.create_task(self._login())
+        return await asyncio.shield(self._login_task)
+
+    async def _login(self) -> bool:
+        login_data = {"email": self.username, "password": self.password}
+        login_response = await self._request("POST", "/auth/login", json=login_data)
+
+        if login_response.status_code != 200 and login_response.status_code != 201:
+            LOGGER.error(
+                "Login failed: %s, %s", login_response.status_code, login_response.text
+            )
+            self.access_token = ""
+            self.account_token = ""
+            self.token_expires_at = None
+            return False
+
+        login_json = json.loads(login_response.text)
+
+        self.access_token = login_json["accessToken"]
+        self.account_token = login_json["accountToken"]
+        if "expiresIn" in login_json:
+            self.token_expires_at = time.time() + float(login_json["expiresIn"])
+        else:
+            self.token_expires_at = token_expiry(self.access_token)
+        self._schedule_refresh()
+        if self.on_token_change:
+            self.on_token_change()
+        return True
+
+    def tokens(self) -> dict:
+        """Tokens to be restored by restore_tokens."""
+        return {
+            "access_token": self.access_token,
+            "account_token": self.account_token,
+            "expires_at": self.token_expires_at,
+        }
+
+    def restore_tokens(self, tokens: dict) -> bool:
+        """Use stored tokens if they are still valid."""
+        expires_at = tokens.get("expires_at")
+        if not tokens.get("access_token") or (
+            expires_at is not None and expires_at <= time.time()
+        ):
+            return False
+        self.access_token = tokens["access_token"]
+        self.account_token = tokens.get("account_token", "")
+        self.token_expires_at = expires_at
+        self._schedule_refresh()
+        return True
+
+    def _schedule_refresh(self):
+        """Login again in the background shortly before the token expires."""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self.token_expires_at is None:
+            return
+        delay = max(self.token_expires_at - TOKEN_REFRESH_MARGIN - time.time(), 0)
+        self._refresh_task = asyncio.create_task(self._refresh_token(delay))
+
+    async def _refresh_token(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            refreshed = await self.login()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            refreshed = False
+        # a refused login drops the token, a lost connection is tried again
+        if not refreshed and self.token_expires_at is not None:
+            LOGGER.warning("Could not refresh the klyqa access token")
+            if not self._token_expired():
+                self._refresh_task = asyncio.create_task(
+                    self._refresh_token(TOKEN_REFRESH_RETRY)
+                )
+
+    def _token_expired(self) -> bool:
+        return self.token_expires_at is not None and time.time() >= self.token_expires_at
+
+    async def request_get(self, url, params=None, headers=None) -> CloudResponse:
+        """Send request get and only if logged out login again and request again."""
+        token = self.access_token
+        response = await self._request("GET", url, params=params, headers=headers)
+        if response.status_code != 401:
+            return response
+        # a parallel request may have logged in again already
+        if self.access_token == token and not await self.login():
+            return response
+        if headers and "Authorization" in headers:
+            headers = {**headers, **self.bearer()}
+        return await self._request("GET", url, params=params, headers=headers)
+
+    async def request_get_beared(self, url, params=None, headers=None) -> CloudResponse:
+        """Send request get and if logged out login again."""
+        if self._token_expired():
+            await self.login()
+        return await self.request_get(
+            url, params, headers={**self.bearer(), **(headers or {})}
+        )
+
+    async def logout(self):
+        """Logout from klyqa account."""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if not self.access_token:
+            return
+        try:
+            await self._request("POST", "/auth/logout", headers=self.bearer())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            LOGGER.debug("Could not logout from klyqa account")
+        self.access_token = ""
+        self.account_token = ""
+        self.token_expires_at = None
+        if self.on_token_change:
+            self.on_token_change()
+
+
 class Klyqa:
     """Klyqa Manager Module"""
 
     lights = {}
-    _access_token = ""
-    _account_token = ""
-    _bearer = {}
+    single_frame_commands = True
+    """Merge light state commands into one request frame, disable for firmware not accepting it."""
 
     def __init__(
         self,
@@ -343,292 +1135,640 @@ class Klyqa:
         hass: HomeAssistant = None,
         disable_cache=False,
         sync_rooms=True,
+        keepalive_interval=KEEPALIVE_INTERVAL,
+        settings_ttl=SETTINGS_TTL,
     ):
-        self._username = username
-        self._password = password
+        self.cloud = KlyqaCloud(username, password, host, hass)
         self.sync_rooms: bool = sync_rooms
-        self._cache_path = DEFAULT_CACHEDB
-        self._host = host
+        self.keepalive_interval = keepalive_interval
+        self.settings_ttl = settings_ttl
+        self.disable_cache = disable_cache
         self.hass = hass
+        self._settings_text = None
+        self._settings_etag = None
+        self._settings_loaded_at = None
+        self._settings_lock = asyncio.Lock()
+        self.product_configs: dict[str, dict] = {}
+        """Product configs by product id, shared by all lights."""
+        self._product_configs_fetched: dict[str, float] = {}
+        self._product_config_tasks: dict[str, asyncio.Task] = {}
+        self.devices: dict[str, DeviceRecord] = {}
+        self.last_addresses: dict[str, str] = {}
+        """Last known ip address per local device id."""
+        self._backoffs: dict[str, Backoff] = {}
+        """Rediscovery backoff per missing light."""
+        self.last_states: dict[str, dict] = {}
+        """Last known status per local device id, kept over restarts."""
+        self.synced_rooms: dict[str, str] = {}
+        """Room names by room id as last applied to the areas."""
+        self._state_listeners: dict[str, list[Callable[[dict], None]]] = {}
+
+        self._store: Store = None
+        self._store_load: asyncio.Task = None
+        self.cloud.on_token_change = self._schedule_save
+
+    async def async_load_store(self):
+        """
+        Restore settings, product configs, bulb addresses and tokens of the
+        account from the Home Assistant storage. Loaded once, later changes
+        are written by schedule save.
+        """
+        if self.disable_cache:
+            return
+        if self._store_load is None:
+            self._store_load = asyncio.create_task(self._async_load_store())
+        await asyncio.shield(self._store_load)
+
+    async def _async_load_store(self):
+        store = Store(self.hass, STORAGE_VERSION, STORAGE_KEY, private=True)
+        data = await store.async_load()
+        self._store = store
+        if not data or data.get("username") != self.cloud.username:
+            return
 
-        # # Create a new cache template
-        # self._cache = {
-        #     "email": None,
-        #     "password": None,
-        # }
-
-        # # Load and merge an existing cache
-        # if not disable_cache:
-        #     self._load_cache()
-
-        # # If the username and password were passed in, update
-        # # the cache and save
-        # if username:
-        #     self._cache["email"] = username
-
-        # if password:
-        #     self._cache["password"] = password
-
-        # self._save_cache()
-        # self.login()
+        if data.get("settings") and self._settings_text is None:
+            self._apply_settings(data["settings"])
+            self._settings_etag = data.get("settings_etag")
+        for product_id, config in data.get("product_configs", {}).items():
+            self.product_configs.setdefault(product_id, config)
+            self._product_configs_fetched.setdefault(
+                product_id, data.get("product_configs_fetched", {}).get(product_id, 0)
+            )
+        for u_id, address in data.get("last_addresses", {}).items():
+            self.last_addresses.setdefault(u_id, address)
+        for u_id, state in data.get("last_states", {}).items():
+            self.last_states.setdefault(u_id, state)
+        if not self.synced_rooms:
+            self.synced_rooms = data.get("synced_rooms", {})
+        if not self.cloud.access_token:
+            self.cloud.restore_tokens(data.get("tokens", {}))
+
+    def _store_data(self) -> dict:
+        return {
+            "username": self.cloud.username,
+            "settings": self._settings_text,
+            "settings_etag": self._settings_etag,
+            "product_configs": self.product_configs,
+            "product_configs_fetched": self._product_configs_fetched,
+            "last_addresses": self.last_addresses,
+            "last_states": self.last_states,
+            "synced_rooms": self.synced_rooms,
+            "tokens": self.cloud.tokens(),
+        }
 
-    def login(self) -> bool:
-        """Login to klyqa account."""
-        self._access_token = ""
-        self._account_token = ""
+    def _schedule_save(self):
+        """Write the state after a delay, changes until then are written at once."""
+        if self._store is not None:
+            self._store.async_delay_save(self._store_data, STORAGE_SAVE_DELAY)
 
-        login_data = {"email": self._username, "password": self._password}
-        login_response = requests.post(self._host + "/auth/login", json=login_data)
+    def add_state_listener(
+        self, u_id, listener: Callable[[dict], None]
+    ) -> Callable[[], None]:
+        """
+        Call listener with every status the light u_id sends on its own, e.g.
+        after a change by the app, a switch or a routine. Returns a function
+        removing the listener.
+        """
+        self._state_listeners.setdefault(u_id, []).append(listener)
 
-        if login_response.status_code != 200 and login_response.status_code != 201:
-            print(str(login_response.status_code) + ", " + str(login_response.text))
-            return False
+        def remove():
+            self._state_listeners[u_id].remove(listener)
 
-        login_json = json.loads(login_response.text)
+        return remove
 
-        self._access_token = login_json["accessToken"]
-        self._account_token = login_json["accountToken"]
+    def _remember_state(self, u_id, state: dict):
+        if state.get("type") == "status" and self.last_states.get(u_id) != state:
+            self.last_states[u_id] = state
+            self._schedule_save()
 
-        self._bearer = {
-            "Authorization": "Bearer " + self._access_token,
-            "X-Request-Id": str(uuid.uuid4()),
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "accept-encoding": "gzip, deflate, utf-8",
+    def _apply_settings(self, settings_text: str):
+        self._settings = json.loads(settings_text)
+        self._settings_text = settings_text
+        self.devices = {
+            device["localDeviceId"]: DeviceRecord.from_settings(device)
+            for device in self._settings["devices"]
         }
-        return True
-
-    def request_get(self, url, params=None, **kwargs):
-        """Send request get and if logged out login again and request again."""
-        response = requests.get(self._host + url, params, **kwargs)
-        if response.status_code == 401 and (not self.login() or not self._access_token):
-            return response
-        response = requests.get(self._host + url, params, **kwargs)
-        return response
-
-    # async def async_request_get(self, url, params=None, **kwargs):
-    #     return await self.hass.async_add_executor_job(self.request_get, url, params, **kwargs)
+        self._index_device_relations()
+
+    def _index_device_relations(self):
+        """Add the rooms, routines and timers to the devices in one pass."""
+        for room in self._settings.get("rooms", []):
+            for device in room["devices"]:
+                if device["localDeviceId"] in self.devices:
+                    self.devices[device["localDeviceId"]].rooms.append(room)
+        for key in ("routines", "timers"):
+            for entry in self._settings.get(key, []):
+                u_ids = {u_id for task in entry["tasks"] for u_id in task["devices"]}
+                for u_id in u_ids:
+                    if u_id in self.devices:
+                        getattr(self.devices[u_id], key).append(entry)
+
+    def _settings_fresh(self) -> bool:
+        return (
+            self._settings_loaded_at is not None
+            and time.monotonic() - self._settings_loaded_at < self.settings_ttl
+        )
 
-    def request_get_beared(self, url, params=None, **kwargs):
-        """Send request get and if logged out login again."""
-        response_object = self.request_get(url, params, headers=self._bearer, **kwargs)
-        return response_object
+    async def async_load_settings(self, force=False) -> bool:
+        """
+        Load settings from klyqa account. The settings are shared by all
+        callers and only requested again after the settings ttl. Parallel
+        callers wait for one request, which is revalidated by its etag.
+        """
+        if not force and self._settings_fresh():
+            return True
 
-    def load_settings(self) -> bool:
-        """Load settings from klyqa account."""
-        settings_response = self.request_get_beared("/settings")
+        async with self._settings_lock:
+            await self.async_load_store()
+            # loaded by a parallel caller in the meantime
+            if not force and self._settings_fresh():
+                return True
+            return await self._async_load_settings()
+
+    async def _async_load_settings(self) -> bool:
+        headers = {}
+        if self._settings_etag and self._settings_text is not None:
+            headers["If-None-Match"] = self._settings_etag
+        settings_response = await self.cloud.request_get_beared(
+            "/settings", headers=headers
+        )
+        if settings_response.status_code == 304:
+            self._settings_loaded_at = time.monotonic()
+            # rooms may not be synced yet, e.g. after turning on the room sync
+            if self.sync_rooms:
+                self._sync_rooms()
+            return True
         if settings_response.status_code != 200:
             return False
-        self._settings = json.loads(settings_response.text)
-
-        if self.sync_rooms and len(self._settings["rooms"]) > 0:
-            LOGGER.debug("Applying rooms from klyqa accounts to Home Assistant")
-            area_reg = ar.async_get(self.hass)
-            for room in self._settings["rooms"]:
-                if not area_reg.async_get_area_by_name(
-                    room["name"]
-                ) and area_reg.async_create(room["name"]):
-                    LOGGER.info("New room created: %s", room["name"])
+        self._settings_loaded_at = time.monotonic()
+        etag = settings_response.headers.get("ETag")
+        if settings_response.text != self._settings_text:
+            self._apply_settings(settings_response.text)
+            self._schedule_save()
+        if etag != self._settings_etag:
+            self._settings_etag = etag
+            self._schedule_save()
+
+        if self.sync_rooms:
+            self._sync_rooms()
 
         return True
 
-    def shutdown(self):
-        """Load settings from klyqa account."""
-        response = requests.post(self._host + "/auth/logout", headers=self._bearer)
-        for light in self.lights:
-            if self.lights[light].connection.socket:
-                try:
-                    self.lights[light].connection.socket.close()
-                except:
-                    pass
+    def _sync_rooms(self):
+        """
+        Apply the rooms of the klyqa account to the Home Assistant areas. Only
+        rooms added or renamed since the last sync are applied.
+        """
+        rooms = {
+            str(room.get("id", room["name"])): room["name"]
+            for room in self._settings["rooms"]
+        }
+        if rooms == self.synced_rooms:
+            return
 
-    search_lights_mutex = threading.Lock()
+        LOGGER.debug("Applying rooms from klyqa accounts to Home Assistant")
+        area_reg = ar.async_get(self.hass)
+        for room_id, name in rooms.items():
+            old_name = self.synced_rooms.get(room_id)
+            if old_name == name or area_reg.async_get_area_by_name(name):
+                continue
+            area = area_reg.async_get_area_by_name(old_name) if old_name else None
+            if area:
+                area_reg.async_update(area.id, name=name)
+                LOGGER.info("Room renamed: %s to %s", old_name, name)
+            elif area_reg.async_create(name):
+                LOGGER.info("New room created: %s", name)
+        self.synced_rooms = rooms
+        self._schedule_save()
+
+    async def _fetch_product_config(self, product_id) -> dict:
+        response = await self.cloud.request_get_beared(
+            "/config/product/" + product_id
+        )
+        if response.status_code != 200:
+            return None
+        return json.loads(response.text)
 
-    def search_lights(self, seconds_to_discover=10, u_id=None):
-        """Get a thread lock safe light searching broadcast of the klyqa bulbs."""
+    async def _async_refresh_product_config(self, product_id) -> dict:
+        # runs unawaited when a cached config was returned, errors end here
+        try:
+            config = await self._fetch_product_config(product_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            LOGGER.debug("Could not refresh product config %s: %s", product_id, ex)
+            return None
+        if config is not None:
+            self.product_configs[product_id] = config
+            self._product_configs_fetched[product_id] = time.time()
+            self._schedule_save()
+        return config
 
-        while True:
-            got_mutex = self.search_lights_mutex.acquire(blocking=False)
-            if not got_mutex and not u_id:
-                return None
-            # If looking for unit_id connection, check if current is now established
-            # (in parallel possible) . Then return it.
+    async def async_get_product_config(self, product_id) -> dict:
+        """
+        Get the product config by product id. Cached configs are returned
+        right away and refreshed in the background once they are older than
+        the product config ttl. Parallel requests for a product share one
+        cloud request.
+        """
+        await self.async_load_store()
+
+        task = self._product_config_tasks.get(product_id)
+        if task is None or task.done():
+            fetched = self._product_configs_fetched.get(product_id, 0)
             if (
-                u_id
-                and u_id in self.lights
-                and not self.lights[u_id].connection.socket._closed
+                product_id in self.product_configs
+                and time.time() - fetched < PRODUCT_CONFIG_TTL
             ):
-                state = self._send_to_bulb(
-                    "--ping",
-                    connection=self.lights[u_id].connection,
-                    reconnect=False,
-                )
-
-                if state and state.get("type") == "pong":
-                    return self.lights[u_id].connection
-                try:
-                    self.lights[u_id].connection.socket.close()
-                    self.lights[u_id].connection.socket._closed = True
-                except Exception:
-                    pass
-            if got_mutex:
-                break
-            if self.search_lights_mutex.acquire(blocking=True, timeout=100):
-                break
+                return self.product_configs[product_id]
+            task = self.hass.async_create_task(
+                self._async_refresh_product_config(product_id)
+            )
+            self._product_config_tasks[product_id] = task
 
-        return_connection = self.__search_lights(seconds_to_discover, u_id)
+        if product_id in self.product_configs:
+            return self.product_configs[product_id]
+        return await asyncio.shield(task)
 
-        LOGGER.info(
-            "Search for bulbs finished. " + str(threading.current_thread().ident),
-        )
-        self.search_lights_mutex.release()
-        return return_connection
+    async def async_shutdown(self, *_, logout=False):
+        """
+        Close the bulb connections. Only an unloaded or replaced account
+        is logged out, a stopping home assistant keeps the stored login
+        for the next start.
+        """
+        await self.async_stop_discovery()
+        for light in self.lights.values():
+            if light.connection:
+                light.connection.close()
+        if logout:
+            await self.cloud.logout()
+
+    _tcp_server: asyncio.AbstractServer = None
+    _udp: asyncio.DatagramTransport = None
+    _broadcast_task: asyncio.Task = None
+    _lights_changed: asyncio.Condition = None
+    _handshake_slots: asyncio.Semaphore = None
+    _rediscovery_task: asyncio.Task = None
+    _rediscovery_wakeup: asyncio.Event = None
+    _supervisor_task: asyncio.Task = None
+    _loop_monitor_task: asyncio.Task = None
+    monitor_loop = False
+    """Run the loop monitor without debug logging too, e.g. in the loop block test."""
+    loop_monitor_interval = LOOP_MONITOR_INTERVAL
+    max_loop_lag = 0.0
+    """Longest event loop block seen by the loop monitor in seconds."""
+
+    async def async_start_discovery(self):
+        """
+        Start the discovery service. The tcp listener stays open so bulbs
+        connecting on their own are taken over at any time, the udp socket
+        is used to broadcast QCX-SYN bursts.
+        """
+        if self._lights_changed is None:
+            self._lights_changed = asyncio.Condition()
+            self._rediscovery_wakeup = asyncio.Event()
+            self._handshake_slots = asyncio.Semaphore(HANDSHAKE_WORKERS)
+        loop = asyncio.get_running_loop()
+
+        if self._udp is None or self._udp.is_closing():
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp.setblocking(False)
+            try:
+                udp.bind(("0.0.0.0", 2222))
+                self._udp, _ = await loop.create_datagram_endpoint(
+                    asyncio.DatagramProtocol, sock=udp
+                )
+            except OSError:
+                LOGGER.error("Could not open udp discovery socket")
+                LOGGER.debug(traceback.format_exc())
+                udp.close()
 
-    def __search_lights(self, seconds_to_discover=10, u_id=None):
+        if self._tcp_server is None:
+            try:
+                self._tcp_server = await asyncio.start_server(
+                    self._handle_bulb_connection,
+                    "0.0.0.0",
+                    3333,
+                    reuse_address=True,
+                )
+                LOGGER.info("Listening for bulbs on tcp port 3333")
+            except OSError:
+                LOGGER.error("Could not listen for bulbs on tcp port 3333")
+                LOGGER.debug(traceback.format_exc())
+
+        if self._rediscovery_task is None:
+            self._rediscovery_task = asyncio.create_task(self._rediscover_missing())
+        if self._supervisor_task is None:
+            self._supervisor_task = asyncio.create_task(self._supervise_connections())
+        if self._loop_monitor_task is None and (
+            self.monitor_loop or LOGGER.isEnabledFor(logging.DEBUG)
+        ):
+            self._loop_monitor_task = asyncio.create_task(self._monitor_loop())
+
+    async def async_stop_discovery(self):
+        """Stop the discovery service."""
+        if self._rediscovery_task is not None:
+            self._rediscovery_task.cancel()
+            self._rediscovery_task = None
+        if self._supervisor_task is not None:
+            self._supervisor_task.cancel()
+            self._supervisor_task = None
+        if self._loop_monitor_task is not None:
+            self._loop_monitor_task.cancel()
+            self._loop_monitor_task = None
+        if self._broadcast_task is not None:
+            self._broadcast_task.cancel()
+            self._broadcast_task = None
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+            self._tcp_server = None
+
+    async def _monitor_loop(self):
         """
-        If the local device id u_id is given, the function will search for lights
-        and return the connection if the light with the u_id is found
-        and a connection could be estasblished.
-        Args:
-            u_id: Local device id.
-            seconds_to_discover: Time to look for the lights from the account devices.
-        returns:
-            connection: If u_id is given.
+        Measure how late the event loop wakes up a sleeping task and report
+        blocks longer than the threshold. Runs with debug logging or if
+        monitor_loop is set, max_loop_lag keeps the longest block.
         """
-        LOGGER.info(
-            "Search for bulbs ... " + str(threading.current_thread().ident),
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.loop_monitor_interval
+            await asyncio.sleep(self.loop_monitor_interval)
+            lag = loop.time() - expected
+            self.max_loop_lag = max(self.max_loop_lag, lag)
+            if lag > LOOP_BLOCK_THRESHOLD:
+                LOGGER.warning("Event loop was blocked for %.3f s", lag)
+
+    async def _handle_bulb_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        Take over a tcp connection a bulb opened to the discovery listener.
+        Every accepted bulb is handshaked in its own task, bounded by the
+        handshake worker slots.
+        """
+        connection = Connection()
+        connection.reader = reader
+        connection.writer = writer
+        connection.address = writer.get_extra_info("peername")
+        set_socket_options(
+            writer.get_extra_info("socket"), self.keepalive_interval
         )
 
-        return_connection = None
-        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        server_address = ("0.0.0.0", 2222)
-        udp.bind(server_address)
-
-        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_address = ("0.0.0.0", 3333)
-        tcp.bind(server_address)
-        tcp.listen()
-
-        time_started = datetime.datetime.now()
-        seconds_left = datetime.timedelta(milliseconds=0)
+        async with self._handshake_slots:
+            self._start_reader(connection)
+            state = await self._send_to_bulb(
+                RequestCmd(), connection=connection, reconnect=False
+            )
+        if not state:
+            connection.close()
+            return
 
-        self.connection_threads = []
+        if (
+            connection.u_id in self.lights
+            and self.lights[connection.u_id].connection is not None
+        ):
+            # don't close open connections
+            if not self.lights[connection.u_id].connection.closed:
+                connection.close()
+                return
+
+            # if there is still a open connection try to close it
+            self.lights[connection.u_id].connection.close()
+        # TODO: Make self.lights better name light_states maybe.
+        self.lights[connection.u_id] = KlyqaLightDevice(
+            state=state, connection=connection
+        )
+        self._remember_state(connection.u_id, state)
+        if (
+            connection.address
+            and self.last_addresses.get(connection.u_id) != connection.address[0]
+        ):
+            self.last_addresses[connection.u_id] = connection.address[0]
+            self._schedule_save()
+        LOGGER.debug("TCP layer connected")
+
+        async with self._lights_changed:
+            self._lights_changed.notify_all()
+
+    def _connected(self, u_id=None) -> bool:
+        """Return True if the light u_id or else all account lights are connected."""
+        u_ids = [u_id] if u_id else self.devices
+        return all(
+            u_id in self.lights
+            and self.lights[u_id].connection is not None
+            and not self.lights[u_id].connection.closed
+            for u_id in u_ids
+        )
 
-        lights_found_num = 0
-        settings_lights_num = len(self._settings["devices"])
+    async def _broadcast(self, seconds_to_discover):
+        """Broadcast QCX-SYN bursts until all lights are connected or time is up."""
+        loop = asyncio.get_running_loop()
+        time_started = loop.time()
         while (
-            lights_found_num < settings_lights_num
-            and seconds_left.seconds < seconds_to_discover
+            not self._connected() and loop.time() - time_started < seconds_to_discover
         ):
             LOGGER.debug("Broadcasting QCX-SYN Burst\n")
-            read_burst_response = True
-            try:
-                udp.sendto(b"QCX-SYN", ("255.255.255.255", 2222))
-            except Exception as exception:
-                read_burst_response = False
-            while read_burst_response:
-                readable, _, _ = select.select([tcp], [], [], 0.1)
-                if tcp in readable:
-                    connection = Connection()
-                    connection.socket, connection.address = tcp.accept()
-                    # almost disable blocking socket
-                    connection.socket.settimeout(0.001)
-                    lights_found_num = lights_found_num + 1
-                    state = self._send_to_bulb(
-                        "--request", connection=connection, reconnect=False
-                    )
-                    if state:
-                        if (
-                            connection.u_id in self.lights
-                            and self.lights[connection.u_id].connection.socket
-                            is not None
-                        ):
-                            # don't close open connections
-                            if not self.lights[
-                                connection.u_id
-                            ].connection.socket._closed:
-                                connection.socket.close()
-                                continue
-
-                            # if there is still a open connection try to close it
-                            try:
-                                self.lights[connection.u_id].connection.socket.close()
-                            except Exception as ex:
-                                pass
-                        # TODO: Make self.lights better name light_states maybe.
-                        self.lights[connection.u_id] = KlyqaLightDevice(
-                            state=state, connection=connection
-                        )
-                        if connection.u_id == u_id:
-                            return_connection = connection
+            if self._udp is not None:
+                self._udp.sendto(b"QCX-SYN", ("255.255.255.255", 2222))
+            await asyncio.sleep(0.2)
 
-                    LOGGER.debug("TCP layer connected")
-                else:
-                    break
+    async def _ping(self, connection: Connection) -> bool:
+        """
+        Ping the bulb without touching a pending command tail.
 
-            time.sleep(0.2)
-            seconds_left = datetime.datetime.now() - time_started
+        Returns:
+            bool: True if the bulb answered with a pong in time.
+        """
+        if connection.closed or not connection.connected.is_set():
+            return False
+        answer = connection.expect(PingCmd.type)
+        if not await send_msg(
+            connection.writer, PingCmd().msg(), connection.sending_aes
+        ):
+            connection.forget(answer)
+            return False
+        try:
+            response = await asyncio.wait_for(asyncio.shield(answer), RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            connection.forget(answer)
+            return False
+        return bool(response) and response.get("type") == "pong"
 
-        tcp.close()
-        if return_connection is not None:
-            return return_connection
+    async def _supervise_connections(self):
+        """
+        Ping the connections idle for longer than the keepalive interval and
+        close the ones not answering, so they are rediscovered before a user
+        command runs into them.
+        """
+        loop = asyncio.get_running_loop()
 
-        return
+        async def check(light: KlyqaLightDevice):
+            connection = light.connection
+            if await self._ping(connection):
+                LOGGER.debug(
+                    "Light %s alive, rtt %.1f ms", connection.u_id, connection.rtt * 1000
+                )
+                return
+            LOGGER.info("Light %s did not answer the keepalive ping", connection.u_id)
+            connection.close()
 
-    def send_to_bulb(self, *argv, u_id=None, **kwargs) -> dict:
+        while True:
+            await asyncio.sleep(self.keepalive_interval / 2)
+            now = loop.time()
+            idle = [
+                light
+                for light in self.lights.values()
+                if light.connection is not None
+                and not light.connection.closed
+                and now - light.connection.last_activity > self.keepalive_interval
+            ]
+            if idle:
+                await asyncio.gather(*(check(light) for light in idle))
+
+    async def _rediscover_missing(self):
+        """
+        Probe the account lights without connection in the background.
+        Each missing light is probed with exponential backoff and jitter,
+        by unicast to its last address first. Lights without an address, or
+        not answering a few unicast probes, e.g. after getting a new address,
+        are also probed in a shared broadcast. The probes are only sent, the
+        discovery listener takes the lights over.
         """
-        Sending commands to the bulb. Put the local device id (u_id) of the bulb
-        in the kwargs arguments. It finds the connection to the bulb by the local device
-        id and sends the command.
+        loop = asyncio.get_running_loop()
+        backoffs = self._backoffs
+        while True:
+            now = loop.time()
+            missing = [u_id for u_id in self.devices if not self._connected(u_id)]
+            for u_id in list(backoffs):
+                if u_id not in missing:
+                    del backoffs[u_id]
+
+            broadcast = False
+            for u_id in missing:
+                backoff = backoffs.setdefault(u_id, Backoff(next_probe=now))
+                if now < backoff.next_probe:
+                    continue
+                backoff.probed(now)
+                if u_id in self.last_addresses:
+                    LOGGER.debug("Probe missing light %s", u_id)
+                    if self._udp is not None:
+                        self._udp.sendto(b"QCX-SYN", (self.last_addresses[u_id], 2222))
+                if (
+                    u_id not in self.last_addresses
+                    or backoff.probes > REDISCOVERY_UNICAST_PROBES
+                ):
+                    broadcast = True
+
+            if broadcast and self._udp is not None:
+                LOGGER.debug("Broadcast probe for missing lights")
+                self._udp.sendto(b"QCX-SYN", ("255.255.255.255", 2222))
+
+            next_probe = min(
+                (backoffs[u_id].next_probe for u_id in missing),
+                default=now + REDISCOVERY_IDLE_INTERVAL,
+            )
+            try:
+                await asyncio.wait_for(
+                    self._rediscovery_wakeup.wait(),
+                    min(max(next_probe - now, 0.2), REDISCOVERY_IDLE_INTERVAL),
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._rediscovery_wakeup.clear()
 
-        Argv:
-            described in code (see parser)
+    def _request_rediscovery(self, u_id):
+        """Probe the light at once, the background rediscovery connects it."""
+        self._backoffs.pop(u_id, None)
+        if self._rediscovery_wakeup is not None:
+            self._rediscovery_wakeup.set()
 
-        Kwargs:
-            connection (Connection): Tcp connection to the bulb.
-            reconnect (bool): Reconnect if tcp connection fails.
+    async def search_lights(self, seconds_to_discover=10):
+        """
+        Search for the klyqa bulbs. Broadcasts discovery bursts and waits for
+        the discovery listener to take over the bulb connections. Parallel
+        searches share the running burst. Single lights lost later are found
+        again by the background rediscovery.
+        Args:
+            seconds_to_discover: Time to look for the lights from the account devices.
+        """
+        await self.async_start_discovery()
+
+        LOGGER.info("Search for bulbs ...")
+        loop = asyncio.get_running_loop()
+        time_started = loop.time()
+        connected_before = {u for u in self.devices if self._connected(u)}
+        time_all_connected = None
+
+        if self._broadcast_task is None or self._broadcast_task.done():
+            self._broadcast_task = asyncio.create_task(
+                self._broadcast(seconds_to_discover)
+            )
+
+        async with self._lights_changed:
+            try:
+                await asyncio.wait_for(
+                    self._lights_changed.wait_for(self._connected),
+                    seconds_to_discover,
+                )
+                time_all_connected = loop.time() - time_started
+            except asyncio.TimeoutError:
+                pass
+
+        elapsed = loop.time() - time_started
+        connected = {u for u in self.devices if self._connected(u)}
+        LOGGER.info(
+            "Search for bulbs finished. %d new of %d/%d lights connected in %.2f s "
+            "(%.1f lights/s), %s.",
+            len(connected - connected_before),
+            len(connected),
+            len(self.devices),
+            elapsed,
+            len(connected - connected_before) / elapsed if elapsed else 0,
+            "all searched lights connected after %.2f s" % time_all_connected
+            if time_all_connected is not None
+            else "not all searched lights connected",
+        )
+
+    async def send(self, u_id, *commands: Command, reconnect=True) -> dict:
+        """
+        Sending commands to the bulb. It finds the connection to the bulb by the
+        local device id (u_id) and sends the commands. Use commands_from_argv
+        for the command line form.
+
+        Args:
+            u_id: Local device id.
+            commands (Command): Typed commands, sent in order.
+            reconnect (bool): Probe a lost light at once, off for periodic polls
+                to keep the rediscovery backoff of lights switched off.
 
         Returns:
             Json object: The answer of the bulb if successful.
             None: Else.
         """
-        # if (
-        #     not isinstance(kwargs, dict)
-        #     or not "u_id" in kwargs
-        #     or not kwargs["u_id"] in self.lights
-        # ):
-        # if not (
-        #     isinstance(kwargs, dict)
-        #     and "u_id" in kwargs
-        #     and kwargs["u_id"] in self.lights
-        # ):
-        #     return None
-        # else:
-        #     u_id = kwargs["u_id"]
         if u_id not in self.lights:
             return None
 
-        # TODO: intervally discover or rediscover bulbs probably in a coordinator class.
-        # if len(self.lights) < len(self._settings["devices"]):  # self._settings.devices
-        #     self.search_lights(1)
-
         response = None
         TRY_MAX = 2
         attempt_num = 1
         while (
             not (
-                response := self._send_to_bulb(
-                    *argv,
+                response := await self._send_to_bulb(
+                    *commands,
                     connection=self.lights[u_id].connection,
-                    retry=attempt_num > 1,
+                    reconnect=reconnect,
                 )
             )
             and attempt_num <= TRY_MAX
         ):
+            connection = self.lights[u_id].connection
+            if connection is None or connection.closed:
+                # the background rediscovery reconnects the light
+                break
             LOGGER.info("No answer from lamp %s. Try resend", str(u_id))
             attempt_num = attempt_num + 1
             if attempt_num >= TRY_MAX:
@@ -636,479 +1776,218 @@ class Klyqa:
 
         return response
 
-    def search_missing_bulbs(self):
-        """TODO: this function is crap. we look if any bulb connection is missing and search then for it. therefore make a list of bulbs missing connection and then look for them."""
-        if len(self.lights) < len(self._settings["devices"]):  # self._settings.devices
-            self.search_lights()
-
-    def _send_to_bulb(self, *argv, retry=False, **kwargs) -> dict:
+    async def _send_to_bulb(
+        self, *commands: Command, connection: Connection, reconnect=True
+    ) -> dict:
         """
-        Sending commands to the bulb. Put the connection object to the bulb
-        in the kwargs arguments.
-
-        Argv:
-            described in code (see parser)
+        Sending commands to the bulb over the connection object to the bulb.
+        The messages are pipelined, the answers are matched to the requests
+        by the reader task of the connection. Commands after a transition are
+        sent by a background tail when the transition is over, a newer command
+        changing the light state cancels the pending tail.
 
         Args:
-            retry (bool): On retry send (True) read tcp socket for data (answers) first, if there is return it.
-                          If not retry resend and try to read again.
-                          On False just send and read for response normal.
-
-        Kwargs:
+            commands (Command): Typed commands, sent in order.
             connection (Connection): Tcp connection to the bulb.
-            reconnect (bool): Reconnect if tcp connection fails.
+            reconnect (bool): Probe the light at once if the tcp connection
+                fails. Reconnecting is left to the background rediscovery so
+                no command waits on a search.
 
         Returns:
-            Json object: The answer of the bulb if successful.
+            Json object: The answer of the bulb to the last message sent directly if successful.
             None: Else.
         """
-        if not isinstance(kwargs, dict) or not "connection" in kwargs:
-            return ""
-        connection: Connection = kwargs["connection"]
-
-        reconnect = True
-        if "reconnect" in kwargs:
-            reconnect = kwargs["reconnect"]
-
-        if not connection.local_iv:
-            connection.state = STATE_WAIT_IV
-            connection.local_iv = get_random_bytes(8)
-        else:
-            connection.state = STATE_CONNECTED
-
-        parser = argparse.ArgumentParser(description="virtual App interface")
-
-        parser.add_argument("--color", nargs=3, help="set color command (r,g,b) 0-255")
-        parser.add_argument(
-            "--temperature",
-            nargs=1,
-            help="set temperature command (kelvin 1000-12000) (1000:warm, 12000:cold)",
-        )
-        parser.add_argument(
-            "--brightness", nargs=1, help="set brightness in percent 0-100"
-        )
-        parser.add_argument(
-            "--percent_color",
-            nargs=5,
-            metavar=("RED", "GREEN", "BLUE", "WARM", "COLD"),
-            help="set colors and white tones in percent 0 - 100",
-        )
-        parser.add_argument(
-            "--transitionTime",
-            nargs=1,
-            help="transition time in milliseconds",
-            default=[0],
-        )
-        parser.add_argument(
-            "--power", nargs=1, metavar='"on"/"off"', help="turns the bulb on/off"
-        )
-        parser.add_argument(
-            "--party",
-            help="blink fast and furious",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-
-        parser.add_argument(
-            "--myip", nargs=1, help="specify own IP for broadcast sender"
-        )
-        parser.add_argument("--ota", nargs=1, help="specify http URL for ota")
-        parser.add_argument(
-            "--ping", help="send ping", action="store_const", const=True, default=False
-        )
-        parser.add_argument(
-            "--request",
-            help="send status request",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--factory_reset",
-            help="trigger a factory reset on the device (Warning: device has to be onboarded again afterwards)",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_list",
-            help="lists stored routines",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_put",
-            help="store new routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_delete",
-            help="delete routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_start",
-            help="start routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_id", help="specify routine id to act on (for put, start, delete)"
-        )
-        parser.add_argument(
-            "--routine_scene", help="specify routine scene label (for put)"
-        )
-        parser.add_argument(
-            "--routine_commands", help="specify routine program (for put)"
-        )
-        parser.add_argument(
-            "--reboot",
-            help="trigger a reboot",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-
-        parser.add_argument(
-            "--passive",
-            help="vApp will passively listen vor UDP SYN from devices",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--enable_tb", nargs=1, help="enable thingsboard connection (yes/no)"
-        )
-
-        if len(argv) < 1:
-            parser.print_help()
-            return
-
-        args = parser.parse_args(argv)
-
-        message_queue_tx = []
-
-        if args.ota is not None:
-            message_queue_tx.append(
-                (json.dumps({"type": "fw_update", "url": args.ota}), 3000)
-            )
-
-        if args.ping:
-            message_queue_tx.append((json.dumps({"type": "ping"}), 10000))
-
-        if args.request:
-            message_queue_tx.append((json.dumps({"type": "request"}), 1000))
-
-        if args.enable_tb is not None:
-            answer = args.enable_tb[0]
-            if answer != "yes" and answer != "no":
-                print("ERROR --enable_tb needs to be yes or no")
-                sys.exit(1)
-
-            message_queue_tx.append(
-                (json.dumps({"type": "backend", "link_enabled": answer}), 1000)
-            )
-
-        if args.passive:
-            pass
+        if connection is None or not commands:
+            return None
 
-        if args.color is not None:
-            r, g, b = args.color
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                color_message(
-                    r, g, b, int(transition_time), skip_wait=args.brightness is not None
-                )
-            )
+        party = next((c for c in commands if isinstance(c, PartyCmd)), None)
+        message_queue_tx = [c for c in commands if not isinstance(c, PartyCmd)]
+        if self.single_frame_commands:
+            message_queue_tx = combine_commands(message_queue_tx)
+        if party and not message_queue_tx:
+            message_queue_tx.append(party.next_color())
+        message_queue_tx.reverse()
 
-        if args.temperature is not None:
-            kelvin = args.temperature[0]
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                temperature_message(
-                    kelvin, int(transition_time), skip_wait=args.brightness is not None
-                )
-            )
+        if connection.closed:
+            if reconnect and connection.u_id:
+                self._request_rediscovery(connection.u_id)
+            return None
 
-        if args.brightness is not None:
-            brightness = args.brightness[0]
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                brightness_message(brightness, int(transition_time))
-            )
+        try:
+            await asyncio.wait_for(connection.connected.wait(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.debug("Handshake timed out with %s", str(connection.address))
+            return None
 
-        if args.percent_color is not None:
-            r, g, b, w, c = args.percent_color
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                percent_color_message(
-                    r,
-                    g,
-                    b,
-                    w,
-                    c,
-                    int(transition_time),
-                    skip_wait=args.brightness is not None,
-                )
-            )
+        # status polls must not drop the rest of a running sequence or party
+        if any(command.changes_state for command in commands):
+            connection.cancel_tail()
+
+        answer = None
+        delay = 0
+        while len(message_queue_tx) > 0:
+            command = message_queue_tx.pop()
+            delay = command.wait_time() / 1000
+            answer = connection.expect(command.type)
+            if not await send_msg(
+                connection.writer, command.msg(), connection.sending_aes
+            ):
+                connection.forget(answer)
+                connection.close()
+                if reconnect and connection.u_id:
+                    self._request_rediscovery(connection.u_id)
+                return None
 
-        if args.factory_reset:
-            message_queue_tx.append((json.dumps({"type": "factory_reset"}), 500))
+            if delay:
+                break
 
-        if args.routine_list:
-            message_queue_tx.append(
-                (json.dumps({"type": "routine", "action": "list"}), 500)
+        if message_queue_tx or party:
+            connection.tail = asyncio.create_task(
+                self._send_tail(connection, message_queue_tx, delay, party)
             )
 
-        if args.routine_put:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {
-                            "type": "routine",
-                            "action": "put",
-                            "id": args.routine_id,
-                            "scene": args.routine_scene,
-                            "commands": args.routine_commands,
-                        }
-                    ),
-                    500,
-                )
-            )
+        if answer is None:
+            return None
 
-        if args.routine_delete:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {"type": "routine", "action": "delete", "id": args.routine_id}
-                    ),
-                    500,
-                )
-            )
-        if args.routine_start:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {"type": "routine", "action": "start", "id": args.routine_id}
-                    ),
-                    500,
-                )
-            )
+        try:
+            # shield the answer, on timeout it is dropped from the in-flight table
+            response = await asyncio.wait_for(asyncio.shield(answer), RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            connection.forget(answer)
+            return None
 
-        if args.power:
-            message_queue_tx.append(
-                (json.dumps({"type": "request", "status": args.power[0]}), 500)
-            )
+        if response is None:
+            LOGGER.debug("Connection lost to %s", str(connection.address))
+            if reconnect and connection.u_id:
+                self._request_rediscovery(connection.u_id)
+        return response
 
-        if args.reboot:
-            message_queue_tx.append((json.dumps({"type": "reboot"}), 500))
+    async def _send_tail(
+        self, connection: Connection, message_queue_tx, delay, party=None
+    ):
+        """
+        Send the rest of a command sequence after the transitions without
+        holding the caller. The answers are left to the in-flight table.
+        """
+        while message_queue_tx or party:
+            if delay:
+                await asyncio.sleep(delay)
+            if party and not message_queue_tx:
+                message_queue_tx.append(party.next_color())
+            command = message_queue_tx.pop()
+            delay = command.wait_time() / 1000
+            connection.expect(command.type).cancel()
+            if not await send_msg(
+                connection.writer, command.msg(), connection.sending_aes
+            ):
+                connection.close()
+                return
 
-        data = []
+    def _start_reader(self, connection: Connection):
+        """Start the reader task owning the incoming stream of the connection."""
+        connection.state = STATE_WAIT_IV
+        connection.local_iv = get_random_bytes(8)
+        connection.last_activity = asyncio.get_running_loop().time()
+        connection.reader_task = asyncio.create_task(self._read_loop(connection))
 
-        message_queue_tx.reverse()
-        last_send = datetime.datetime.now()
-
-        def do_reconnect():
-            """Try reconnect only once per send."""
-            nonlocal reconnect, self
-            reconnect = False
-            # self.load_settings()
-            return self.search_lights(u_id=connection.u_id)
-
-        if connection.socket._closed:
-            connection = do_reconnect()
-
-        pause = datetime.timedelta(milliseconds=0)
-        elapsed = datetime.datetime.now() - last_send
-        aes_key = ""
-        while len(message_queue_tx) > 0 or elapsed < pause or args.party:
-            try:
-                data = connection.socket.recv(4096)
-                if data == "":
-                    print("wrong")
+    async def _read_loop(self, connection: Connection):
+        """
+        Read the tcp stream of the bulb for the lifetime of the connection.
+        Incoming bytes are accumulated in the connection buffer and complete
+        packets are dispatched, partial packets are kept for the next read.
+        """
+        try:
+            while True:
+                data = await connection.reader.read(4096)
                 if len(data) == 0:
                     LOGGER.debug("EOF")
-                    if reconnect:
-                        connection = do_reconnect()
-                        continue
-                    else:
-                        return
-            except socket.timeout:
-                # LOGGER.debug("timeout")
-                # continue
-                pass
-            except ConnectionResetError:
-                if reconnect:
-                    connection = do_reconnect()
-                    continue
-                else:
-                    return
-            except socket.error as e:
-                if e.errno != errno.ECONNRESET and reconnect:
-                    if reconnect:
-                        connection = do_reconnect()
-                        continue
-                    reconnect = False
-            except Exception as exception:
-                # if e.errno != errno.ECONNRESET and reconnect:
-                if reconnect:
-                    connection = do_reconnect()
-                    if connection:
-                        continue
-                    else:
-                        return
-                else:
-                    return
-
-            elapsed = datetime.datetime.now() - last_send
-
-            """Resend message to lamp when retrying and no message has come yet to read.
-            Else read message below."""
-            if connection.state == STATE_CONNECTED and (not retry or len(data) == 0):
-                send_next = elapsed >= pause
-                if len(message_queue_tx) > 0 and send_next:
-                    msg, ts = message_queue_tx.pop()
-                    pause = datetime.timedelta(milliseconds=ts)
-                    if not send_msg(connection.socket, msg, connection.sending_aes):
-                        """Upon send error, try reconnect to the lamps and append message for transmission again."""
-                        try:
-                            connection.socket.close()
-                        except Exception as exception:
-                            pass
-                        if reconnect:
-                            connection = do_reconnect()
-                            if connection:
-                                message_queue_tx.append((msg, ts))
-                            else:
-                                return None
-                        else:
-                            return None
-                    last_send = datetime.datetime.now()
-
-            if args.party and len(message_queue_tx) < 2:
-                r, g, b = get_random_bytes(3)
-
-                brightness = 50
-                if args.brightness is not None:
-                    brightness = int(args.brightness[0])
-                transition_time = 300
-                if args.transitionTime is not None:
-                    transition_time = int(args.transitionTime[0])
-                message_queue_tx.append(
-                    color_message(r, g, b, transition_time, brightness)
-                )
-                pause = datetime.timedelta(milliseconds=transition_time)
-
-            while len(data):
+                    break
                 LOGGER.debug(
                     "TCP server received "
                     + str(len(data))
                     + " bytes from "
                     + str(connection.address)
                 )
-
-                pkg_len = data[0] * 256 + data[1]
-                pkg_type = data[3]
-
-                pkg = data[4 : 4 + pkg_len]
-                if len(pkg) < pkg_len:
+                connection.buffer += data
+                connection.last_activity = asyncio.get_running_loop().time()
+                self._dispatch_packets(connection)
+        except (ConnectionError, OSError, ValueError, KeyError):
+            LOGGER.debug(traceback.format_exc())
+        finally:
+            connection.close()
+            # wake up the senders waiting for an answer
+            connection.fail_in_flight()
+
+    def _dispatch_packets(self, connection: Connection):
+        """Process all complete packets of the connection buffer."""
+        buffer = connection.buffer
+        offset = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= 4:
+                pkg_len = view[offset] * 256 + view[offset + 1]
+                pkg_type = view[offset + 3]
+                if len(buffer) - offset - 4 < pkg_len:
                     LOGGER.debug("Incomplete packet, waiting for more...")
                     break
+                with view[offset + 4 : offset + 4 + pkg_len] as pkg:
+                    self._process_packet(connection, pkg_type, pkg)
+                offset = offset + 4 + pkg_len
+        del buffer[:offset]
+
+    def _process_packet(self, connection: Connection, pkg_type, pkg: memoryview):
+        """Handle the iv handshake and decrypt the answers of the bulb."""
+        if connection.state == STATE_WAIT_IV and pkg_type == 0:
+            LOGGER.debug("Plain: " + str(bytes(pkg)))
+            response_object = json.loads(bytes(pkg))
+            connection.u_id = response_object["ident"]["unit_id"]
+            device = self.devices.get(connection.u_id)
+            if device:
+                connection.aes_key = device.aes_key
+
+            connection.writer.write(bytes([0, 8, 0, 1]) + connection.local_iv)
+
+        elif connection.state == STATE_WAIT_IV and pkg_type == 1:
+            connection.remote_iv = bytes(pkg)
+
+            connection.sending_aes = AES.new(
+                connection.aes_key,
+                AES.MODE_CBC,
+                iv=connection.local_iv + connection.remote_iv,
+            )
+            connection.receiving_aes = AES.new(
+                connection.aes_key,
+                AES.MODE_CBC,
+                iv=connection.remote_iv + connection.local_iv,
+            )
 
-                data = data[4 + pkg_len :]
-
-                if connection.state == STATE_WAIT_IV and pkg_type == 0:
-                    LOGGER.debug("Plain: " + str(pkg))
-                    response_object = json.loads(pkg)
-                    connection.u_id = response_object["ident"]["unit_id"]
-                    for device in self._settings["devices"]:
-                        if device["localDeviceId"] == connection.u_id:
-                            aes_key = bytes.fromhex(device["aesKey"])
-                            break
-
-                    connection.socket.send(bytes([0, 8, 0, 1]) + connection.local_iv)
-
-                if connection.state == STATE_WAIT_IV and pkg_type == 1:
-                    connection.remote_iv = pkg
-
-                    connection.sending_aes = AES.new(
-                        aes_key,
-                        AES.MODE_CBC,
-                        iv=connection.local_iv + connection.remote_iv,
-                    )
-                    connection.receiving_aes = AES.new(
-                        aes_key,
-                        AES.MODE_CBC,
-                        iv=connection.remote_iv + connection.local_iv,
-                    )
-
-                    connection.state = STATE_CONNECTED
-
-                elif connection.state == STATE_CONNECTED and pkg_type == 2:
-                    cipher = pkg
-
-                    response_plain = connection.receiving_aes.decrypt(cipher)
-                    response_decoded = ""
-                    try:
-                        response_decoded = response_plain.decode("utf-8")
-                    except Exception as exception:
-                        response_decoded = str(response_plain)
-                    uid = connection.u_id + " " if connection.u_id else ""
-                    LOGGER.debug("Decrypted: " + uid + response_decoded)
-                    try:
-                        response = json.loads(response_decoded)
-                    except Exception as exception:
-                        return
-                    if connection.u_id and connection.u_id in self.lights:
-                        self.lights[connection.u_id].state = response
-                    return response
-
-    def _load_cache(self):
-        """Load existing cache and merge for updating if required."""
-        if os.path.exists(self._cache_path):
-            LOGGER.debug("Cache found at: %s", self._cache_path)
-            loaded_cache = self._load_cache_filesystem()
-
-            if loaded_cache:
-                self.update(self._cache, loaded_cache)
-            else:
-                LOGGER.debug("Removing invalid cache file: %s", self._cache_path)
-                os.remove(self._cache_path)
-
-        self._save_cache()
-
-    def _load_cache_filesystem(self):
-        """Load cache file from the filesystem."""
-        filename = self._cache_path
-        with open(filename, "rb") as handle:
-            try:
-                return pickle.load(handle)
-            except EOFError:
-                LOGGER.warning("Empty pickle file: %s", filename)
-            except (pickle.UnpicklingError, ValueError):
-                LOGGER.warning("Corrupted pickle file: %s", filename)
-
-            return None
+            connection.state = STATE_CONNECTED
+            connection.connected.set()
 
-    def update(self, dct, dct_merge):
-        """Recursively merge dicts."""
-        for key, value in dct_merge.items():
-            if key in dct and isinstance(dct[key], dict):
-                dct[key] = self.update(dct[key], value)
-            else:
-                dct[key] = value
-        return dct
-
-    def _save_cache(self, data=None):
-        filename = self._cache_path
-        data = self._cache
-        """Save login data to file."""
-        with open(filename, "wb") as handle:
-            pickle.dump(data, handle)
+        elif connection.state == STATE_CONNECTED and pkg_type == 2:
+            response_plain = connection.receiving_aes.decrypt(pkg)
+            response_decoded = ""
+            try:
+                response_decoded = response_plain.decode("utf-8")
+            except Exception as exception:
+                response_decoded = str(response_plain)
+            uid = connection.u_id + " " if connection.u_id else ""
+            LOGGER.debug("Decrypted: " + uid + response_decoded)
+            try:
+                response = json.loads(response_decoded)
+            except Exception as exception:
+                return
+            if connection.u_id and connection.u_id in self.lights:
+                self.lights[connection.u_id].state = response
+                self._remember_state(connection.u_id, response)
+            if not connection.resolve(response):
+                LOGGER.debug("Unrequested answer from %s", str(connection.u_id))
+                if response.get("type") == "status":
+                    for listener in self._state_listeners.get(connection.u_id, []):
+                        try:
+                            listener(response)
+                        except Exception:  # pylint: disable=broad-except
+                            # listener errors must not close the bulb connection
+                            LOGGER.error(
+                                "Error in state listener of %s", connection.u_id
+                            )
+                            LOGGER.debug(traceback.format_exc())
@@ -0,0 +1,85 @@
+"""
+Microbenchmark of the bulb message framing in frames per second on one core.
+
+Run from the directory containing the integration, e.g. custom_components:
+
+    python -m klyqa.benchmark --seconds 2
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
+
+from .api import ColorCmd, LightStateCmd, PowerCmd, RequestCmd, frame_msg
+
+MESSAGES = {
+    "request": RequestCmd().msg(),
+    "power": PowerCmd("on").msg(),
+    "light state": LightStateCmd([ColorCmd(255, 128, 0, 500), PowerCmd("on")]).msg(),
+}
+
+
+def frame_msg_loop(message: dict, sending_aes) -> bytes:
+    """The first framing: byte by byte padding and concatenation."""
+    message_encoded = json.dumps(message).encode("utf-8")
+    while len(message_encoded) % 16:
+        message_encoded = message_encoded + bytes([0x20])
+    cipher = sending_aes.encrypt(message_encoded)
+    return bytes([len(cipher) // 256, len(cipher) % 256, 0, 2]) + cipher
+
+
+def frame_msg_inplace(message: dict, sending_aes) -> bytearray:
+    """Encryption in place into a preallocated frame."""
+    message_encoded = json.dumps(message).encode("utf-8")
+    length = len(message_encoded) + (-len(message_encoded) % 16)
+    frame = bytearray(4 + length)
+    frame[0] = length // 256
+    frame[1] = length % 256
+    frame[3] = 2
+    frame[4 : 4 + len(message_encoded)] = message_encoded
+    frame[4 + len(message_encoded) :] = b" " * (length - len(message_encoded))
+    with memoryview(frame)[4:] as payload:
+        sending_aes.encrypt(payload, output=payload)
+    return frame
+
+
+FRAMINGS = {
+    "frame_msg": frame_msg,
+    "in place": frame_msg_inplace,
+    "loop": frame_msg_loop,
+}
+
+
+def measure(frame, message: dict, seconds: float) -> float:
+    """Return the frames per second of one core framing the message."""
+    sending_aes = AES.new(get_random_bytes(16), AES.MODE_CBC, iv=get_random_bytes(16))
+    frames = 0
+    started = time.process_time()
+    while (elapsed := time.process_time() - started) < seconds:
+        for _ in range(1000):
+            frame(message, sending_aes)
+        frames += 1000
+    return frames / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--seconds", type=float, default=1, help="cpu seconds per measurement"
+    )
+    args = parser.parse_args()
+
+    print(f"{'message':18}" + "".join(f"{name:>14}" for name in FRAMINGS))
+    for name, message in MESSAGES.items():
+        zero_aes = AES.new(bytes(16), AES.MODE_CBC, iv=bytes(16))
+        size = len(frame_msg(message, zero_aes))
+        rates = [measure(f, message, args.seconds) for f in FRAMINGS.values()]
+        print(f"{name:12}{size:4d} B" + "".join(f"{rate:10.0f} f/s" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
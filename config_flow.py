@@ -1,10 +1,11 @@
 """Config flow for Klyqa."""
 # import my_pypi_dependency
 
+import asyncio
 from typing import Any, cast
 from numpy import integer
 
-from requests.exceptions import ConnectTimeout, HTTPError
+from aiohttp import ClientError
 import voluptuous as vol
 
 from homeassistant.core import HomeAssistant
@@ -12,7 +13,7 @@ from homeassistant.helpers import config_entry_flow
 
 from . import api
 from .api import Klyqa
-from .const import CONF_POLLING, DEFAULT_CACHEDB, DOMAIN, LOGGER
+from .const import CONF_POLLING, DOMAIN, LOGGER
 import homeassistant.helpers.config_validation as cv
 
 from homeassistant import config_entries
@@ -23,7 +24,7 @@ from homeassistant.const import (
     CONF_ROOM,
     CONF_USERNAME,
 )
-from .const import CONF_SYNC_ROOMS
+from .const import CONF_KEEPALIVE_INTERVAL, CONF_SYNC_ROOMS
 from homeassistant.data_entry_flow import FlowResult
 
 # user_step_data_schema = {
@@ -40,6 +41,7 @@ user_step_data_schema = {
     vol.Required(CONF_PASSWORD, default="testpwd1"): str,
     vol.Required(CONF_SCAN_INTERVAL, default=60): int,
     vol.Required(CONF_SYNC_ROOMS, default=True): bool,
+    vol.Required(CONF_KEEPALIVE_INTERVAL, default=api.KEEPALIVE_INTERVAL): int,
     vol.Required(CONF_HOST, default="http://localhost:3000"): str,
 }
 
@@ -81,8 +83,8 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
         self._username: str | None = None
         self._password: str | None = None
-        self._cache: str | None = None
         self._scan_interval: int = 30
+        self._keepalive_interval: int = api.KEEPALIVE_INTERVAL
         self._host: str | None = None
         self._klyqa = None
         pass
@@ -101,10 +103,10 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             return self.async_abort(reason="single_instance_allowed")
 
         """ already logged in from platform or other way """
-        if self.klyqa() and self._klyqa._access_token:
-            self._username = self._klyqa._username
-            self._password = self._klyqa._password
-            self._host = self._klyqa._host
+        if self.klyqa() and self._klyqa.cloud.access_token:
+            self._username = self._klyqa.cloud.username
+            self._password = self._klyqa.cloud.password
+            self._host = self._klyqa.cloud.host
             return await self._async_create_entry()
         login_failed = False
 
@@ -117,18 +119,18 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         self._password = user_input[CONF_PASSWORD]
         self._scan_interval = user_input[CONF_SCAN_INTERVAL]
         self._sync_rooms = user_input[CONF_SYNC_ROOMS]
+        self._keepalive_interval = user_input[CONF_KEEPALIVE_INTERVAL]
         self._host = user_input[CONF_HOST]
 
         return await self._async_klyqa_login(step_id="user")
 
     async def _async_klyqa_login(self, step_id: str) -> FlowResult:
         """Handle login with Klyqa."""
-        # self._cache = self.hass.config.path(DEFAULT_CACHEDB)
         errors = {}
         if DOMAIN in self.hass.data:
             self._klyqa = self.hass.data[DOMAIN]
             try:
-                await self.hass.async_add_executor_job(self._klyqa.shutdown)
+                await self._klyqa.async_shutdown(logout=True)
             except Exception as e:
                 pass
 
@@ -140,16 +142,15 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 self._host,
                 self.hass,
                 sync_rooms=self._sync_rooms,
+                keepalive_interval=self._keepalive_interval,
             )
-            if not await self.hass.async_add_executor_job(
-                self._klyqa.login,
-            ):
+            if not await self._klyqa.cloud.login():
                 raise Exception("Unable to login")
 
             if self._klyqa:
                 self.hass.data[DOMAIN] = self._klyqa
 
-        except (ConnectTimeout, HTTPError):
+        except (ClientError, asyncio.TimeoutError) as ex:
             LOGGER.error("Unable to connect to Klyqa: %s", ex)
             errors = {"base": "cannot_connect"}
 
@@ -158,7 +159,7 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             LOGGER.error("Unable to connect to Klyqa: %s", ex)
             errors = {"base": "cannot_connect"}
 
-        if not self._klyqa or not self._klyqa._access_token:
+        if not self._klyqa or not self._klyqa.cloud.access_token:
             errors = {"base": "cannot_connect"}
 
         if errors:
@@ -177,6 +178,7 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             CONF_PASSWORD: self._password,
             CONF_SCAN_INTERVAL: self._scan_interval,
             CONF_SYNC_ROOMS: self._sync_rooms,
+            CONF_KEEPALIVE_INTERVAL: self._keepalive_interval,
             CONF_HOST: self._host,
         }
         existing_entry = await self.async_set_unique_id(self._username)
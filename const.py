@@ -11,6 +11,11 @@ LOGGER = logging.getLogger(__package__)
 DOMAIN = "klyqa"
 
 
-DEFAULT_CACHEDB = "klyqa.cache"
+STORAGE_KEY = DOMAIN
+STORAGE_VERSION = 1
 CONF_POLLING = "polling"
+# seconds between two state requests to all lights
+DEFAULT_SCAN_INTERVAL = 60
 CONF_SYNC_ROOMS = "sync_rooms"
+# seconds a bulb connection may idle before it is pinged
+CONF_KEEPALIVE_INTERVAL = "keepalive_interval"
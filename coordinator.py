@@ -0,0 +1,56 @@
+"""Polling of all Klyqa lights of the account."""
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+
+from aiohttp import ClientError
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
+
+from .api import Klyqa, RequestCmd
+from .const import DOMAIN, LOGGER
+
+
+class KlyqaCoordinator(DataUpdateCoordinator):
+    """Request the states of all lights in one cycle and hand them to the entities."""
+
+    discovery_done = False
+    """Lights not found yet keep their last known state until the first search ended."""
+
+    def __init__(
+        self, hass: HomeAssistant, klyqa: Klyqa, update_interval: timedelta
+    ) -> None:
+        super().__init__(hass, LOGGER, name=DOMAIN, update_interval=update_interval)
+        self.klyqa = klyqa
+
+    async def _async_update_data(self) -> dict[str, dict]:
+        """Fetch the light states by local device id, None for lights not answering."""
+        try:
+            # both are cached, the cloud is only asked after their ttl
+            await self.klyqa.async_load_settings()
+            for product_id in {
+                device.product_id for device in self.klyqa.devices.values()
+            }:
+                await self.klyqa.async_get_product_config(product_id)
+        except (ClientError, asyncio.TimeoutError) as ex:
+            LOGGER.debug("Klyqa cloud not reachable, using loaded settings: %s", ex)
+
+        u_ids = [
+            u_id
+            for u_id in self.klyqa.devices
+            if self.discovery_done or u_id in self.klyqa.lights
+        ]
+        states = await asyncio.gather(
+            # lights lost are left to the rediscovery backoff, not probed per poll
+            *(
+                self.klyqa.send(u_id, RequestCmd(), reconnect=False)
+                for u_id in u_ids
+            ),
+            return_exceptions=True,
+        )
+        return {
+            u_id: state if isinstance(state, dict) else None
+            for u_id, state in zip(u_ids, states)
+        }
@@ -1,9 +1,11 @@
 """Platform for light integration."""
 from __future__ import annotations
 
-import json
+import asyncio
 import socket
 
+from aiohttp import ClientError
+
 from homeassistant.helpers.device_registry import DeviceEntryType
 from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers import area_registry as ar
@@ -42,6 +44,7 @@ from homeassistant.const import (
     ATTR_ENTITY_ID,
     CONF_HOST,
     CONF_PASSWORD,
+    CONF_SCAN_INTERVAL,
     CONF_USERNAME,
     EVENT_HOMEASSISTANT_STOP,
     STATE_UNAVAILABLE,
@@ -49,18 +52,39 @@ from homeassistant.const import (
     STATE_OFF,
     STATE_ON,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 
 # Import the device class from the component that you want to support
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import DeviceInfo, Entity, generate_entity_id
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 import homeassistant.util.color as color_util
 from homeassistant.config_entries import ConfigEntry
 
-from .api import SCENES, Klyqa, KlyqaLightDevice
-from .const import DOMAIN, LOGGER, CONF_SYNC_ROOMS
+from .api import (
+    KEEPALIVE_INTERVAL,
+    SCENES,
+    BrightnessCmd,
+    ColorCmd,
+    Klyqa,
+    KlyqaLightDevice,
+    PercentColorCmd,
+    PowerCmd,
+    RequestCmd,
+    RoutinePut,
+    RoutineStart,
+    TemperatureCmd,
+)
+from .const import (
+    CONF_KEEPALIVE_INTERVAL,
+    CONF_SYNC_ROOMS,
+    DEFAULT_SCAN_INTERVAL,
+    DOMAIN,
+    LOGGER,
+)
+from .coordinator import KlyqaCoordinator
 
 # all deprecated, still here for testing, color_mode is the modern way to go ...
 SUPPORT_KLYQA = (
@@ -77,8 +101,6 @@ import functools as ft
 from homeassistant.helpers.area_registry import AreaEntry, AreaRegistry
 import homeassistant.helpers.area_registry as area_registry
 
-SCAN_INTERVAL = timedelta(seconds=3)
-
 
 async def async_setup(hass: HomeAssistant, yaml_config: ConfigType) -> bool:
     return True
@@ -123,66 +145,80 @@ async def async_setup_klyqa(
         sync_rooms = (
             config.get(CONF_SYNC_ROOMS) if config.get(CONF_SYNC_ROOMS) else False
         )
-        hass.data[DOMAIN] = Klyqa(username, password, host, hass, sync_rooms=sync_rooms)
-        if not await hass.async_add_executor_job(hass.data[DOMAIN].login):
-            return
+        hass.data[DOMAIN] = Klyqa(
+            username,
+            password,
+            host,
+            hass,
+            sync_rooms=sync_rooms,
+            keepalive_interval=config.get(CONF_KEEPALIVE_INTERVAL)
+            or KEEPALIVE_INTERVAL,
+        )
 
     klyqa: Klyqa = hass.data[DOMAIN]
 
-    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa.shutdown)
-    await hass.async_add_executor_job(klyqa.load_settings)
-    await hass.async_add_executor_job(
-        ft.partial(klyqa.search_lights, seconds_to_discover=1)
-    )
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa.async_shutdown)
+    await klyqa.async_load_store()
+    # only a first start waits for the cloud, else the stored devices are used
+    if not klyqa.devices and not await klyqa.async_load_settings():
+        return
 
-    entities = []
+    coordinator = KlyqaCoordinator(
+        hass,
+        klyqa,
+        timedelta(seconds=config.get(CONF_SCAN_INTERVAL) or DEFAULT_SCAN_INTERVAL),
+    )
+    entities: dict[str, KlyqaLight] = {}
+
+    def add_new_entities():
+        new_entities = []
+        for u_id, record in klyqa.devices.items():
+            if u_id in entities:
+                continue
+            entity_id = generate_entity_id(
+                ENTITY_ID_FORMAT,
+                u_id,
+                hass=hass,
+            )
 
-    for device_settings in klyqa._settings["devices"]:
-        entity_id = generate_entity_id(
-            ENTITY_ID_FORMAT,
-            device_settings["localDeviceId"],
-            hass=hass,
-        )
-        u_id = device_settings["localDeviceId"]
-
-        light_state = klyqa.lights[u_id] if u_id in klyqa.lights else KlyqaLightDevice()
-        rooms = []
-        for room in klyqa._settings["rooms"]:
-            for device in room["devices"]:
-                if device["localDeviceId"] == u_id:
-                    rooms.append(room)
-        # TODO: perhaps the routines can be put into automations or scenes in HA
-        routines = []
-        for routine in klyqa._settings["routines"]:
-            for task in routine["tasks"]:
-                for device in task["devices"]:
-                    if device == u_id:
-                        routines.append(routine)
-        # TODO: same for timers.
-        timers = []
-        for timer in klyqa._settings["timers"]:
-            for task in timer["tasks"]:
-                for device in task["devices"]:
-                    if device == u_id:
-                        timers.append(timer)
-
-        entities.append(
-            KlyqaLight(
-                device_settings,
+            light_state = (
+                klyqa.lights[u_id]
+                if u_id in klyqa.lights
+                else KlyqaLightDevice(state=klyqa.last_states.get(u_id, {}))
+            )
+            entities[u_id] = KlyqaLight(
+                record.settings,
                 light_state,
                 klyqa,
                 entity_id,
-                should_poll=True,
-                rooms=rooms,
-                timers=timers,
-                routines=routines,
+                coordinator,
+                # TODO: perhaps the routines and timers can be put into
+                # automations or scenes in HA
+                rooms=record.rooms,
+                timers=record.timers,
+                routines=record.routines,
             )
-        )
-
-    add_entities(entities, True)
-
-
-class KlyqaLight(LightEntity):
+            new_entities.append(entities[u_id])
+        add_entities(new_entities, False)
+
+    async def async_reconcile():
+        """Check the stored devices with the cloud and connect the lights."""
+        try:
+            if not klyqa.cloud.access_token:
+                await klyqa.cloud.login()
+            if await klyqa.async_load_settings(force=True):
+                add_new_entities()
+        except (ClientError, asyncio.TimeoutError) as ex:
+            LOGGER.warning("Klyqa cloud not reachable, using stored devices: %s", ex)
+        await klyqa.search_lights(seconds_to_discover=1)
+        coordinator.discovery_done = True
+        await coordinator.async_refresh()
+
+    add_new_entities()
+    hass.async_create_task(async_reconcile())
+
+
+class KlyqaLight(CoordinatorEntity, LightEntity):
     """Representation of a Klyqa Light."""
 
     _attr_supported_features = SUPPORT_KLYQA
@@ -200,17 +236,17 @@ class KlyqaLight(LightEntity):
         device: KlyqaLightDevice,
         klyqa_api,
         entity_id,
-        should_poll=True,
+        coordinator: KlyqaCoordinator,
         rooms=None,
         timers=None,
         routines=None,
     ):
         """Initialize a Klyqa Light Bulb."""
+        super().__init__(coordinator)
         self._klyqa_api = klyqa_api
         self.u_id = settings["localDeviceId"]
         self._klyqa_device = device
         self.entity_id = entity_id
-        self._attr_should_poll = should_poll
         self._attr_device_class = "light"
         self._attr_icon = "mdi:lightbulb"
         self.rooms = rooms
@@ -223,26 +259,29 @@ class KlyqaLight(LightEntity):
             # COLOR_MODE_RGBWW
         }
         self._attr_effect_list = [x["label"] for x in SCENES]
-        """Entity state will be updated after adding the entity."""
+        # entity starts with the last known state and is updated after adding it
+        self._apply_settings(settings)
+        if device.state:
+            self._update_state(device.state)
 
     async def async_update_settings(self):
         """Set device specific settings from the klyqa settings cloud."""
-        devices_settings = self._klyqa_api._settings["devices"]
-
-        device_result = [
-            x for x in devices_settings if str(x["localDeviceId"]) == self.u_id
-        ]
-        if len(device_result) < 1:
+        device = self._klyqa_api.devices.get(self.u_id)
+        if device is None:
             return
 
-        response_object = await self.hass.async_add_executor_job(
-            self._klyqa_api.request_get_beared,
-            "/config/product/" + device_result[0]["productId"],
-        )
+        await self._klyqa_api.async_get_product_config(device.product_id)
+        self._update_settings(device)
 
-        self.device_config = json.loads(response_object.text)
+    def _update_settings(self, device):
+        self.device_config = self._klyqa_api.product_configs.get(device.product_id)
+        self.rooms = device.rooms
+        self.timers = device.timers
+        self.routines = device.routines
+        self._apply_settings(device.settings)
 
-        self.settings = device_result[0]
+    def _apply_settings(self, settings):
+        self.settings = settings
         self._attr_name = self.settings["name"]
         self._attr_unique_id = self.settings["localDeviceId"]
         self._attr_device_info = DeviceInfo(
@@ -255,10 +294,12 @@ class KlyqaLight(LightEntity):
             configuration_url="https://www.klyqa.de/produkte/e27-color-lampe",  # TODO: Maybe exclude. Or make rest call for device url.
         )
         if len(self.rooms) > 0:
-            area_reg = ar.async_get(self.hass)
-            area = area_reg.async_get_area_by_name(self.rooms[0]["name"])
-            if area:
-                self._attr_device_info["suggested_area"] = area.name
+            room_name = self.rooms[0]["name"]
+            # synced rooms are created as areas with the settings
+            if self._klyqa_api.sync_rooms or (
+                self.hass and ar.async_get(self.hass).async_get_area_by_name(room_name)
+            ):
+                self._attr_device_info["suggested_area"] = room_name
 
     @property
     def entity_registry_enabled_default(self) -> bool:
@@ -270,8 +311,13 @@ class KlyqaLight(LightEntity):
 
         entity_registry = er.async_get(self.hass)
 
-        await self.async_update_klyqa()
-        args = ["--power", "on"]
+        commands = []
+
+        if ATTR_TRANSITION in kwargs:
+            self._attr_transition_time = kwargs[ATTR_TRANSITION]
+
+        transition = self._attr_transition_time or 0
+        skip_wait = ATTR_BRIGHTNESS in kwargs or ATTR_BRIGHTNESS_PCT in kwargs
 
         if ATTR_HS_COLOR in kwargs:
             rgb = color_util.color_hs_to_RGB(*kwargs[ATTR_HS_COLOR])
@@ -282,111 +328,124 @@ class KlyqaLight(LightEntity):
             self._attr_rgb_color = kwargs[ATTR_RGB_COLOR]
 
         if ATTR_RGB_COLOR in kwargs or ATTR_HS_COLOR in kwargs:
-            args.extend(["--color", *([str(rgb) for rgb in self._attr_rgb_color])])
-
-        if ATTR_RGBWW_COLOR in kwargs:
-            self._attr_rgbww_color = kwargs[ATTR_RGBWW_COLOR]
-            args.extend(
-                ["--percent_color", *([str(rgb) for rgb in self._attr_rgbww_color])]
+            commands.append(
+                ColorCmd(*self._attr_rgb_color, transition, skip_wait=skip_wait)
             )
 
-        if ATTR_EFFECT in kwargs:
-            scene_result = [x for x in SCENES if x["label"] == kwargs[ATTR_EFFECT]]
-            if len(scene_result) > 0:
-                scene = scene_result[0]
-                self._attr_effect = kwargs[ATTR_EFFECT]
-                commands = scene["commands"]
-                if len(commands.split(";")) > 2:
-                    commands += "l 0;"
-
-                ret = self._klyqa_api.send_to_bulb(
-                    "--routine_id",
-                    "0",
-                    "--routine_scene",
-                    str(scene["id"]),
-                    "--routine_put",
-                    "--routine_command",
-                    commands,
-                    u_id=self.u_id,
-                )
-                if ret:
-                    args.extend(
-                        [
-                            "--routine_id",
-                            "0",
-                            "--routine_start",
-                        ]
-                    )
-
         if ATTR_COLOR_TEMP in kwargs:
             self._attr_color_temp = kwargs[ATTR_COLOR_TEMP]
-            args.extend(
-                [
-                    "--temperature",
-                    str(
-                        color_temperature_mired_to_kelvin(self._attr_color_temp)
-                        if self._attr_color_temp
-                        else 0
-                    ),
-                ]
+            commands.append(
+                TemperatureCmd(
+                    color_temperature_mired_to_kelvin(self._attr_color_temp)
+                    if self._attr_color_temp
+                    else 0,
+                    transition,
+                    skip_wait=skip_wait,
+                )
             )
 
-        if ATTR_TRANSITION in kwargs:
-            self._attr_transition_time = kwargs[ATTR_TRANSITION]
-
-        if self._attr_transition_time:
-            args.extend(["--transitionTime", str(self._attr_transition_time)])
-
         if ATTR_BRIGHTNESS in kwargs:
             self._attr_brightness = kwargs[ATTR_BRIGHTNESS]
-            args.extend(
-                ["--brightness", str(round((self._attr_brightness / 255.0) * 100.0))]
+            commands.append(
+                BrightnessCmd(round((self._attr_brightness / 255.0) * 100.0), transition)
             )
 
         if ATTR_BRIGHTNESS_PCT in kwargs:
             self._attr_brightness = int(
                 round((kwargs[ATTR_BRIGHTNESS_PCT] / 100) * 255)
             )
-            args.extend(["--brightness", str(ATTR_BRIGHTNESS_PCT)])
+            commands.append(BrightnessCmd(kwargs[ATTR_BRIGHTNESS_PCT], transition))
+
+        if ATTR_RGBWW_COLOR in kwargs:
+            self._attr_rgbww_color = kwargs[ATTR_RGBWW_COLOR]
+            commands.append(
+                PercentColorCmd(*self._attr_rgbww_color, transition, skip_wait=skip_wait)
+            )
+
+        commands.append(PowerCmd("on"))
+
+        if ATTR_EFFECT in kwargs:
+            scene_result = [x for x in SCENES if x["label"] == kwargs[ATTR_EFFECT]]
+            if len(scene_result) > 0:
+                scene = scene_result[0]
+                self._attr_effect = kwargs[ATTR_EFFECT]
+                scene_commands = scene["commands"]
+                if len(scene_commands.split(";")) > 2:
+                    scene_commands += "l 0;"
+
+                ret = await self._klyqa_api.send(
+                    self.u_id,
+                    RoutinePut("0", str(scene["id"]), scene_commands),
+                )
+                if ret:
+                    commands.append(RoutineStart("0"))
 
         LOGGER.info(
             "Send to bulb " + str(self.entity_id) + "%s: %s",
             " (" + self.name + ")" if self.name else "",
-            " ".join(args),
+            commands,
         )
-        ret = self._klyqa_api.send_to_bulb(*(args), u_id=self.u_id)
-        await self.async_update()
+        await self._async_send(*commands)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
-        args = ["--power", "off"]
-        if self._attr_transition_time:
-            args.extend(["--transitionTime", str(self._attr_transition_time)])
-        await self.async_update_klyqa()
+        commands = [PowerCmd("off")]
         LOGGER.info(
             "Send to bulb " + str(self.entity_id) + "%s: %s",
             " (" + self.name + ")" if self.name else "",
-            " ".join(args),
+            commands,
         )
-        ret = self._klyqa_api.send_to_bulb(*(args), u_id=self.u_id)
-        await self.async_update()
+        await self._async_send(*commands)
+
+    async def _async_send(self, *commands):
+        """
+        Send the commands and take the state from the answer of the bulb. The
+        settings are left to the coordinator, commands only wait for the bulb.
+        """
+        ret = await self._klyqa_api.send(self.u_id, *commands)
+        if not isinstance(ret, dict) or ret.get("type") != "status":
+            ret = await self._klyqa_api.send(self.u_id, RequestCmd())
+        self._update_state(ret)
+        self.async_write_ha_state()
 
     async def async_update_klyqa(self):
         """Fetch settings from klyqa cloud account."""
-        await self.hass.async_add_executor_job(self._klyqa_api.load_settings)
+        await self._klyqa_api.async_load_settings()
         await self.async_update_settings()
-        # if self._attr_state == STATE_UNAVAILABLE:
-        #     await self.hass.async_add_executor_job(self._klyqa_api.search_missing_bulbs)
 
     async def async_update(self):
-        """Fetch new state data for this light.
+        """Fetch new state data for this light only.
 
-        This is the only method that should fetch new data for Home Assistant.
+        All lights are polled together by the coordinator, this is used when
+        an update of the entity is requested.
         """
         await self.async_update_klyqa()
-        ret = self._klyqa_api.send_to_bulb("--request", u_id=self.u_id)
+        ret = await self._klyqa_api.send(self.u_id, RequestCmd())
         self._update_state(ret)
 
+    async def async_added_to_hass(self) -> None:
+        """Listen to states the light pushes on its own."""
+        await super().async_added_to_hass()
+        self.async_on_remove(
+            self._klyqa_api.add_state_listener(self.u_id, self._handle_pushed_state)
+        )
+
+    @callback
+    def _handle_pushed_state(self, state: dict) -> None:
+        self._update_state(state)
+        self.async_write_ha_state()
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Take the state of the light from the last refresh of all lights."""
+        device = self._klyqa_api.devices.get(self.u_id)
+        if device is not None and device.settings is not self.settings:
+            self._update_settings(device)
+        # no data if the last refresh failed
+        if self.coordinator.data and self.u_id in self.coordinator.data:
+            self._update_state(self.coordinator.data[self.u_id])
+        self.async_write_ha_state()
+
     def _update_state(self, state_complete):
         """Process state request response from the bulb to the entity state."""
         # self.state = STATE_OK if state_complete else STATE_UNAVAILABLE
@@ -424,33 +483,36 @@ class KlyqaLight(LightEntity):
             return
 
         self._klyqa_device.state = state_complete
-        self._attr_color_temp = (
-            color_temperature_kelvin_to_mired(state_complete["temperature"])
-            if state_complete["temperature"]
-            else 0
-        )
+        # fields missing in a partial status keep their last value
+        if "temperature" in state_complete:
+            self._attr_color_temp = (
+                color_temperature_kelvin_to_mired(state_complete["temperature"])
+                if state_complete["temperature"]
+                else 0
+            )
 
-        self._attr_rgb_color = (
-            state_complete["color"]["red"],
-            state_complete["color"]["green"],
-            state_complete["color"]["blue"],
-        )
-        self._attr_hs_color = color_util.color_RGB_to_hs(*self._attr_rgb_color)
+        color = state_complete.get("color")
+        if color and all(key in color for key in ("red", "green", "blue")):
+            self._attr_rgb_color = (color["red"], color["green"], color["blue"])
+            self._attr_hs_color = color_util.color_RGB_to_hs(*self._attr_rgb_color)
         # interpolate brightness from klyqa bulb 0 - 100 percent to homeassistant 0 - 255 points
-        self._attr_brightness = (
-            float(state_complete["brightness"]["percentage"]) / 100
-        ) * 255
-        self._attr_is_on = state_complete["status"] == "on"
-
-        self._attr_color_mode = (
-            COLOR_MODE_COLOR_TEMP
-            if state_complete["mode"] == "cct"
-            else "effect"
-            if state_complete["mode"] == "cmd"
-            else state_complete["mode"]
-        )
-        self._attr_effect = ""
-        if "active_scene" in state_complete and state_complete["mode"] == "cmd":
+        brightness = state_complete.get("brightness") or {}
+        if "percentage" in brightness:
+            self._attr_brightness = (float(brightness["percentage"]) / 100) * 255
+        if "status" in state_complete:
+            self._attr_is_on = state_complete["status"] == "on"
+
+        mode = state_complete.get("mode")
+        if mode:
+            self._attr_color_mode = (
+                COLOR_MODE_COLOR_TEMP
+                if mode == "cct"
+                else "effect"
+                if mode == "cmd"
+                else mode
+            )
+            self._attr_effect = ""
+        if "active_scene" in state_complete and mode == "cmd":
             scene_result = [
                 x for x in SCENES if str(x["id"]) == state_complete["active_scene"]
             ]
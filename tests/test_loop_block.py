@@ -0,0 +1,172 @@
+"""
+Event loop block check: fake bulbs on localhost are driven through the
+turn on, poll and transition paths while the loop monitor runs, the test
+fails if any step held the event loop longer than LOOP_BLOCK_THRESHOLD.
+
+Needs Home Assistant and pycryptodomex installed, run from the integration
+folder:
+
+    python -m pytest tests
+"""
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import json
+from pathlib import Path
+import sys
+
+import pytest
+
+pytest.importorskip("homeassistant")
+pytest.importorskip("Cryptodome")
+
+from Cryptodome.Cipher import AES  # noqa: E402
+from Cryptodome.Random import get_random_bytes  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+if "klyqa" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "klyqa", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)]
+    )
+    sys.modules["klyqa"] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules["klyqa"])
+
+from klyqa.api import (  # noqa: E402
+    LOOP_BLOCK_THRESHOLD,
+    BrightnessCmd,
+    ColorCmd,
+    DeviceRecord,
+    Klyqa,
+    PowerCmd,
+    RequestCmd,
+    RoutineStart,
+)
+
+BULBS = 8
+POLLS = 20
+TRANSITION = 300
+
+
+class FakeBulb:
+    """Bulb connecting to the discovery listener and answering like firmware."""
+
+    def __init__(self, u_id: str, aes_key: bytes):
+        self.u_id = u_id
+        self.aes_key = aes_key
+        self.state = {
+            "type": "status",
+            "status": "off",
+            "brightness": {"percentage": 50},
+        }
+        self.received: list[dict] = []
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+
+    async def run(self, port=3333):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        ident = json.dumps({"type": "ident", "ident": {"unit_id": self.u_id}})
+        self._write(0, ident.encode())
+        local_iv = await self._read()
+        remote_iv = get_random_bytes(8)
+        self._write(1, remote_iv)
+        receiving_aes = AES.new(self.aes_key, AES.MODE_CBC, iv=local_iv + remote_iv)
+        self.sending_aes = AES.new(self.aes_key, AES.MODE_CBC, iv=remote_iv + local_iv)
+        while True:
+            try:
+                pkg = await self._read()
+            except asyncio.IncompleteReadError:
+                return
+            message = json.loads(receiving_aes.decrypt(pkg))
+            self.received.append(message)
+            await self._answer(message)
+
+    async def _read(self) -> bytes:
+        header = await self.reader.readexactly(4)
+        return await self.reader.readexactly(header[0] * 256 + header[1])
+
+    def _write(self, pkg_type: int, pkg: bytes):
+        self.writer.write(bytes([len(pkg) // 256, len(pkg) % 256, 0, pkg_type]) + pkg)
+
+    async def _answer(self, message: dict):
+        if message["type"] == "routine":
+            answer = {"type": "routine", "action": message["action"]}
+        else:
+            self.state.update(
+                (key, value)
+                for key, value in message.items()
+                if key not in ("type", "transitionTime")
+            )
+            answer = self.state
+        payload = json.dumps(answer).encode()
+        payload += b" " * (-len(payload) % 16)
+        self._write(2, self.sending_aes.encrypt(payload))
+        await self.writer.drain()
+
+
+async def drive_bulbs() -> Klyqa:
+    klyqa = Klyqa("user", "password", "http://127.0.0.1", disable_cache=True)
+    klyqa.lights = {}
+    klyqa.monitor_loop = True
+    klyqa.loop_monitor_interval = 0.01
+    bulbs = [FakeBulb(f"bulb{i}", get_random_bytes(16)) for i in range(BULBS)]
+    klyqa.devices = {
+        bulb.u_id: DeviceRecord(bulb.u_id, bulb.aes_key, "product", {})
+        for bulb in bulbs
+    }
+    await klyqa.async_start_discovery()
+    bulb_tasks = [asyncio.create_task(bulb.run()) for bulb in bulbs]
+    try:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while len(klyqa.lights) < BULBS:
+            assert loop.time() - started < 5, "fake bulbs did not connect"
+            await asyncio.sleep(0.05)
+
+        # turn on with color and brightness
+        states = await asyncio.gather(
+            *(
+                klyqa.send(
+                    bulb.u_id,
+                    ColorCmd(255, 128, 0, 0),
+                    BrightnessCmd(80, 0),
+                    PowerCmd("on"),
+                )
+                for bulb in bulbs
+            )
+        )
+        assert all(state and state["status"] == "on" for state in states)
+
+        # coordinator polls
+        for _ in range(POLLS):
+            states = await asyncio.gather(
+                *(
+                    klyqa.send(bulb.u_id, RequestCmd(), reconnect=False)
+                    for bulb in bulbs
+                )
+            )
+            assert all(states)
+
+        # transition with the scene start sent by the tail afterwards
+        await asyncio.gather(
+            *(
+                klyqa.send(
+                    bulb.u_id, ColorCmd(0, 0, 255, TRANSITION), RoutineStart("0")
+                )
+                for bulb in bulbs
+            )
+        )
+        await asyncio.sleep(TRANSITION / 1000 + 0.2)
+        assert all(bulb.received[-1]["type"] == "routine" for bulb in bulbs)
+    finally:
+        await klyqa.async_shutdown()
+        for bulb, task in zip(bulbs, bulb_tasks):
+            if bulb.writer:
+                bulb.writer.close()
+            task.cancel()
+    return klyqa
+
+
+def test_event_loop_not_blocked():
+    klyqa = asyncio.run(drive_bulbs())
+    assert klyqa.max_loop_lag < LOOP_BLOCK_THRESHOLD